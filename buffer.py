@@ -21,11 +21,10 @@
 
 import colorsys
 import hashlib
-import mimetypes
 import os
 import random
 import sys
-from functools import cmp_to_key
+import threading
 
 import taglib
 from core.utils import *
@@ -35,20 +34,38 @@ from PyQt6 import QtCore
 from PyQt6.QtCore import QThread
 from PyQt6.QtGui import QColor
 
-try:
-    from mutagen.easyid3 import EasyID3
-except ImportError:
-    EasyID3 = None
-
 sys.path.append(os.path.dirname(__file__))
+from cover_cache import get_shared_cover_cache
+from library_watcher import LibraryWatcher, stop_thread
 from music_config import MusicConfig
 from netease_backend import NeteaseBackend
 
 from music_service import music_service
-from music_service.utils import get_config_cache_file, get_logger, normalize_path
+from music_service.collation import collation_key
+from music_service.crawler import AudioCrawler, get_audio_extensions
+from music_service.file_cache import get_shared_cache
+from music_service.library import MusicLibrary
+from music_service.miss_cache import MissCache
+from music_service.scoreboard import ProviderScoreboard
+from music_service.search_memo import SearchMemo
+from music_service.task_pool import TaskPool
+from music_service.track_table import TrackTable
+from music_service.utils import get_config_cache_file, get_db_cache_file, get_logger, normalize_path
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 log = get_logger('AppBuffer')
 
+# Longest side of the cover sample the lyric color is picked from.
+LIGHT_SAMPLE_SIZE = 256
+
+# Longest side of the cover sample and number of colors the audio motion gradient is picked from.
+PALETTE_SAMPLE_SIZE = 128
+PALETTE_COLORS = 64
+
 class PlaySourceType:
     Local = 'local'
     Cloud = 'cloud'
@@ -81,8 +98,15 @@ class AppBuffer(BrowserBuffer):
                 self._config.play_mode = 'list'
 
         self.play_track_key = ''
-        self.local_tracks = {}
-        self.thread_queue = []
+        self.local_tracks = TrackTable('path')
+        self.library = MusicLibrary(get_db_cache_file('library.db'))
+        self.crawler = AudioCrawler(get_audio_extensions(self.get_music_extensions()))
+        self.library_scanner = None
+        self.library_watcher = None
+        # Cover and lyric jobs of the current track, pending jobs of skipped tracks are dropped.
+        self.media_pool = TaskPool('MediaPool', workers=4, max_pending=16)
+        # Covers and lyrics of the next tracks, one thread so prefetch never competes with the current track.
+        self.prefetch_pool = TaskPool('PrefetchPool', workers=1, max_pending=16)
 
         self.first_file = os.path.expanduser(url)
         self.panel_background_color = QColor(self.theme_background_color).darker(110).name()
@@ -90,13 +114,30 @@ class AppBuffer(BrowserBuffer):
         self.icon_cache_dir = normalize_path(os.path.join(os.path.dirname(__file__), "src", "svg_cache"))
         self.cover_cache_dir = normalize_path(os.path.join(os.path.dirname(__file__), "src", "cover_cache"))
         self.lyrics_cache_dir = normalize_path(os.path.join(os.path.dirname(__file__), "src", "lyrics_cache"))
+        self.cover_files = get_shared_cache('cover_files', self.cover_cache_dir,
+                                            self.get_cache_bytes("eaf-music-cover-cache-size"), extension='.png')
+        self.lyric_files = get_shared_cache('lyric_files', self.lyrics_cache_dir,
+                                            self.get_cache_bytes("eaf-music-lyric-cache-size"), extension='.lyc')
         self.light_cover_path = normalize_path(os.path.join(os.path.dirname(__file__), "src", "cover", "light_cover.svg"))
         self.dark_cover_path = normalize_path(os.path.join(os.path.dirname(__file__), "src", "cover", "dark_cover.svg"))
 
+        race_grace = get_emacs_var("eaf-music-provider-race-grace")
+        music_service.set_race_mode(bool(get_emacs_var("eaf-music-provider-race")),
+                                    race_grace / 1000 if isinstance(race_grace, int) and race_grace >= 0 else 0.3)
+        # Shared by all buffers, a later one must not drop the unsaved stats and circuits.
+        if music_service.get_scoreboard() is None:
+            music_service.set_scoreboard(ProviderScoreboard(get_db_cache_file('provider_stats.json')))
+        miss_ttl = get_emacs_var("eaf-music-lookup-miss-ttl")
+        if not isinstance(miss_ttl, int) or miss_ttl < 0:
+            miss_ttl = 0
+        if miss_ttl > 0 and music_service.get_miss_cache() is None:
+            music_service.set_miss_cache(MissCache(get_db_cache_file('lookup_misses.json'), miss_ttl))
+        if music_service.get_search_memo() is None:
+            music_service.set_search_memo(SearchMemo(get_db_cache_file('search_memo.db'), miss_ttl))
+
         self.theme_background_rgb_color = hex_to_rgb(self.theme_background_color)
+        self.cover_cache = get_shared_cover_cache(get_db_cache_file('cover_analysis.json'), self.theme_background_color)
 
-        if not os.path.exists(self.lyrics_cache_dir):
-            os.makedirs(self.lyrics_cache_dir)
         if not os.path.exists(self.icon_cache_dir):
             os.makedirs(self.icon_cache_dir)
 
@@ -119,6 +160,8 @@ class AppBuffer(BrowserBuffer):
     def update_theme(self):
         super().update_theme()
         self.panel_background_color = QColor(self.theme_background_color).darker(110).name()
+        self.theme_background_rgb_color = hex_to_rgb(self.theme_background_color)
+        self.cover_cache.set_background_color(self.theme_background_color)
 
         self.init_icons()
         self.init_vars()
@@ -136,7 +179,9 @@ class AppBuffer(BrowserBuffer):
             self.icon_cache_dir,
             self.cover_cache_dir,
             "/",
-            self.get_default_cover_path()
+            self.get_default_cover_path(),
+            self.get_prefetch_count(),
+            self.get_preload_depth()
         )
 
     def init_app(self):
@@ -145,20 +190,99 @@ class AppBuffer(BrowserBuffer):
 
         self.init_vars()
 
-        files = []
+        self.scan_local_tracks()
 
-        if os.path.isdir(self.first_file):
-            files = list(filter(lambda f : os.path.isfile(f),
-                                [os.path.join(dp, f) for dp, dn, filenames in os.walk(self.first_file) for f in filenames]))
-        elif os.path.isfile(self.first_file):
-            files.append(self.first_file)
+        self.init_music_service()
+        self._netease_backend.init_app(self._config.cloud_playlist_id, self._config.cloud_track_id)
+
+    def destroy_buffer(self):
+        # Qt aborts the process when a running QThread is destroyed, stop the library threads first.
+        if self.library_scanner is not None:
+            self.library_scanner.scan_batch.disconnect(self.append_local_tracks)
+            self.library_scanner.scan_finished.disconnect(self.update_local_tracks)
+            stop_thread(self.library_scanner)
+        if self.library_watcher is not None:
+            self.library_watcher.stop()
+        self.media_pool.shutdown()
+        self.prefetch_pool.shutdown()
+
+        BrowserBuffer.destroy_buffer(self)
+
+    def scan_local_tracks(self):
+        # Scan in background and stream tracks to the playlist, so the last played track
+        # can start as soon as it is found instead of after the whole tree is read.
+        self.library_scanner = LibraryScanner(self.library, self.crawler, self.first_file, self.get_scan_workers())
+        self.library_scanner.scan_batch.connect(self.append_local_tracks)
+        self.library_scanner.scan_finished.connect(self.update_local_tracks)
+        self.library_scanner.start()
 
-        track_list = self.pick_music_info(files)
-        self.local_tracks = {x['path']:x for x in track_list}
-        self.buffer_widget.eval_js_function('addLocalTrackInfos', track_list)
+    @PostGui()
+    def append_local_tracks(self, tracks):
+        self.local_tracks.extend(tracks)
+        self.buffer_widget.eval_js_function('appendLocalTrackInfos', self.encode_local_tracks(tracks))
 
-        self.init_music_service()
-        self._netease_backend.init_app(self._config.cloud_playlist_id)
+    @PostGui()
+    def update_local_tracks(self, tracks):
+        self.local_tracks.replace(tracks)
+        self.buffer_widget.eval_js_function('addLocalTrackInfos', self.encode_local_tracks(tracks))
+
+        # Follow later changes of the music directory without full rescans.
+        if self.library_scanner.directories:
+            self.library_watcher = LibraryWatcher(self.library,
+                                                  self.crawler,
+                                                  self.first_file,
+                                                  self.library_scanner.directories,
+                                                  get_emacs_var("eaf-music-watch-poll-interval") or 0)
+            self.library_watcher.tracks_changed.connect(self.patch_local_tracks)
+
+    def patch_local_tracks(self, tracks, removed):
+        removed_ids = []
+        for path in removed:
+            track_id = self.local_tracks.get_id(path)
+            if track_id is not None:
+                removed_ids.append(track_id)
+                self.local_tracks.remove(path)
+        self.local_tracks.extend(tracks)
+        self.buffer_widget.eval_js_function('patchLocalTrackInfos', self.encode_local_tracks(tracks), removed_ids)
+
+    def encode_local_tracks(self, tracks):
+        return self.local_tracks.encode([track['path'] for track in tracks], self._config.local_track_path)
+
+    def get_music_extensions(self):
+        extensions = get_emacs_var("eaf-music-extension-list")
+        if isinstance(extensions, str):
+            return extensions.split()
+        return extensions or []
+
+    def get_scan_workers(self):
+        workers = get_emacs_var("eaf-music-scan-workers")
+        if isinstance(workers, int) and workers > 0:
+            return workers
+        return os.cpu_count() or 1
+
+    def get_prefetch_count(self):
+        count = get_emacs_var("eaf-music-prefetch-count")
+        if isinstance(count, int) and count > 0:
+            return count
+        return 0
+
+    def get_cache_bytes(self, var_name):
+        size = get_emacs_var(var_name)
+        if isinstance(size, int) and size > 0:
+            return size
+        return 0
+
+    def get_preload_depth(self):
+        depth = get_emacs_var("eaf-music-preload-depth")
+        if isinstance(depth, int) and depth > 0:
+            return depth
+        return 0
+
+    def get_preload_bytes(self):
+        budget = get_emacs_var("eaf-music-preload-bytes")
+        if isinstance(budget, int) and budget > 0:
+            return budget
+        return 0
 
     def init_music_service(self):
         port = get_free_port()
@@ -180,15 +304,29 @@ class AppBuffer(BrowserBuffer):
     def vue_update_play_mode(self, mode: str):
         self._config.play_mode = mode
 
-    @QtCore.pyqtSlot(str, str)
-    def vue_update_current_track(self, play_source, play_track_key):
+    @QtCore.pyqtSlot(str, str, bool)
+    def vue_update_current_track(self, play_source, track_id, preloaded):
+        # The webview only knows track ids, resolve the local path or cloud song id.
+        if play_source == PlaySourceType.Local:
+            play_track_key = self.local_tracks.get_key(int(track_id))
+        else:
+            play_track_key = self._netease_backend.get_track_key(int(track_id))
         log.debug(f'start play source: {play_source}, key: {play_track_key}')
+        if play_track_key is None:
+            return
+
         self.play_source = play_source
         self.play_track_key = play_track_key
+        self.media_pool.set_current_group(self.get_current_track_unikey())
+        self.prefetch_pool.set_current_group(self.get_current_track_unikey())
 
-        if not self.is_local_source():
+        if self.is_local_source():
+            if not preloaded:
+                self.buffer_widget.eval_js_function('updateTrackAudioSource', self.play_track_key)
+        else:
             self._netease_backend.fetch_track_audio_source(self.play_track_key,
-                                                           self.get_current_track_unikey())
+                                                           self.get_current_track_unikey(),
+                                                           preloaded)
 
         track_infos = self.get_current_play_track_info()
         if track_infos:
@@ -202,6 +340,62 @@ class AppBuffer(BrowserBuffer):
             else:
                 self._config.cloud_track_id = int(play_track_key)
 
+    @QtCore.pyqtSlot(str, str)
+    def vue_prefetch_tracks(self, play_source, track_ids):
+        # Ids of the tracks coming next in play order, sent after the current one started.
+        unikey = self.get_current_track_unikey()
+        tracks = []
+        for track_id in track_ids.split(','):
+            if not track_id:
+                continue
+            if play_source == PlaySourceType.Local:
+                infos = self.local_tracks.get(self.local_tracks.get_key(int(track_id)))
+            else:
+                infos = self._netease_backend.get_prefetch_track_info(int(track_id))
+            if infos:
+                tracks.append((int(track_id), infos))
+
+        # Audio first, it is what a track switch waits for.
+        preload_tracks = tracks[:self.get_preload_depth()]
+        if preload_tracks:
+            if play_source == PlaySourceType.Local:
+                resolve_source = resolve_local_audio_source
+            else:
+                resolve_source = self._netease_backend.resolve_audio_source
+            self.prefetch_pool.submit(unikey, select_preload_sources, preload_tracks, resolve_source,
+                                      self.get_preload_bytes(),
+                                      callback=lambda sources: self.preload_audio_sources(unikey, play_source, sources))
+
+        for _, infos in tracks[:self.get_prefetch_count()]:
+            if play_source == PlaySourceType.Cloud:
+                self._netease_backend.prefetch_track_audio_source(infos)
+
+            song_id = infos.get('id', 0)
+            self.prefetch_pool.submit(unikey, prefetch_cover, self.cover_files, self.cover_cache,
+                                      infos['artist'], infos['name'], infos['album'], song_id,
+                                      self.theme_background_rgb_color)
+            self.prefetch_pool.submit(unikey, fetch_lyric_text, self.lyric_files,
+                                      infos['name'], infos['artist'], infos['album'], song_id)
+
+    @PostGui()
+    def preload_audio_sources(self, track_unikey, play_source, sources):
+        if self.is_current_play_track(track_unikey):
+            self.buffer_widget.eval_js_function('preloadTrackAudioSources', play_source, sources)
+
+    @QtCore.pyqtSlot(str)
+    def vue_jump_to_file(self, track_id):
+        path = self.local_tracks.get_key(int(track_id))
+        if path:
+            eval_in_emacs('eaf-open-in-file-manager', [path])
+
+    @QtCore.pyqtSlot(str, str)
+    def vue_sort_tracks(self, display_source, field):
+        if display_source == PlaySourceType.Local:
+            ids = self.local_tracks.order(field)
+        else:
+            ids = self._netease_backend.get_track_order(field)
+        self.buffer_widget.eval_js_function('sortTrackInfos', display_source, ids)
+
     @QtCore.pyqtSlot(str)
     def vue_update_playlist_tracks(self, playlist_id: str):
         playlist_id = int(playlist_id)
@@ -224,7 +418,7 @@ class AppBuffer(BrowserBuffer):
     def get_current_play_track_info(self):
         track_unikey = self.get_current_track_unikey()
         if self.is_local_source():
-            infos = self.local_tracks[self.play_track_key]
+            infos = self.local_tracks.get(self.play_track_key)
         else:
             infos = self._netease_backend.get_track_info(self.play_track_key)
         if not infos:
@@ -232,53 +426,29 @@ class AppBuffer(BrowserBuffer):
         infos['unikey'] = track_unikey
         return infos
 
-    def _get_tag_value(self, tags, key: str) -> str:
-        values = tags.get(key, None)
-        if not values:
-            return ''
-        return values[0]
-
-    def get_audio_taginfos(self, file_path: str) -> dict:
-        tags = taglib.File(file_path).tags
-        title_key = 'TITLE'
-        artist_key = 'ARTIST'
-        album_key = 'ALBUM'
-        if not self._get_tag_value(tags, title_key):
-            if EasyID3 is not None:
-                try:
-                    tags = EasyID3(file_path)
-                    title_key = title_key.lower()
-                    artist_key = artist_key.lower()
-                    album_key = album_key.lower()
-                except Exception:
-                    pass
-        title = self._get_tag_value(tags, title_key)
-        if not title:
-            title = os.path.splitext(os.path.basename(file_path))[0]
-        return {
-            'path': file_path,
-            'title': title,
-            'artist': self._get_tag_value(tags, artist_key),
-            'album': self._get_tag_value(tags, album_key)
-        }
-
     def fetch_cover(self, infos):
         artist = infos['artist']
         title = infos['name']
         album = infos['album']
         unikey = infos['unikey']
         song_id = infos.get('id', 0)
-        cover_path = get_cover_path(self.cover_cache_dir, artist, title)
+        # A miss is counted by the thread that goes online, don't count it here too.
+        cover_name = get_cover_name(artist, title)
+        cover_path = self.cover_files.lookup(cover_name) if cover_name in self.cover_files else None
 
         # Fill default cover if no match cover found.
-        if not os.path.exists(cover_path):
+        if not cover_path:
             self.buffer_widget.eval_js_function("updateCover", self.get_default_cover_path())
             self.buffer_widget.eval_js_function("updateLyricColor", "#CCCCCC")
-            fetch_cover_thread = FetchCover(unikey, self.cover_cache_dir, artist, title, album, song_id)
-            fetch_cover_thread.fetch_result.connect(self.update_cover)
-            fetch_cover_thread.fetch_failed.connect(self.update_audio_motion_gradient)
-            self.thread_queue.append(fetch_cover_thread)
-            fetch_cover_thread.start()
+
+            def handle_cover(cover_path):
+                if cover_path:
+                    self.update_cover(unikey, cover_path)
+                else:
+                    # Default cover colors, unless the track was skipped meanwhile.
+                    self.update_cover_colors(unikey, False, None)
+            self.media_pool.submit(unikey, fetch_cover_file, self.cover_files, artist, title, album, song_id,
+                                   callback=handle_cover)
         else:
             self.update_cover(unikey, cover_path)
 
@@ -290,17 +460,12 @@ class AppBuffer(BrowserBuffer):
         album = infos['album']
         unikey = infos['unikey']
         song_id = infos.get('id', 0)
-        lyric_path = get_lyric_path(self.lyrics_cache_dir, artist, title)
-
-        if os.path.exists(lyric_path):
-            with open(lyric_path, "r") as f:
-                self.update_lyric(unikey, f.read())
-        else:
+        # Cached lyrics are read by the thread too, only show the hint when it goes online.
+        # The thread does the counted lookup, a plain membership test keeps the stats right.
+        if get_lyric_name(artist, title) not in self.lyric_files:
             self.update_lyric(unikey, '[99:00.000]正在搜索歌词，请稍等')
-            fetch_lyric_thread = FetchLyric(unikey, self.lyrics_cache_dir, title, artist, album, song_id)
-            fetch_lyric_thread.fetch_result.connect(self.update_lyric)
-            self.thread_queue.append(fetch_lyric_thread)
-            fetch_lyric_thread.start()
+        self.media_pool.submit(unikey, fetch_lyric_text, self.lyric_files, title, artist, album, song_id,
+                               callback=lambda lyric: self.update_lyric(unikey, lyric))
 
     @PostGui()
     def update_lyric(self, track_unikey, lyric):
@@ -313,47 +478,30 @@ class AppBuffer(BrowserBuffer):
         # Only update cover when
         if self.is_current_play_track(track_unikey):
             self.buffer_widget.eval_js_function("updateCover", url)
+
+            # Decoding the cover is left to a worker, only its result comes back here.
+            self.media_pool.submit(track_unikey, analyze_cover, self.cover_cache, url, self.theme_background_rgb_color,
+                                   callback=lambda result: self.update_cover_colors(track_unikey, *result))
+
+    @PostGui()
+    def update_cover_colors(self, track_unikey, light, colors):
+        if self.is_current_play_track(track_unikey):
             self.buffer_widget.eval_js_function("updateLyricColor",
-                                                "#3F3F3F" if is_light_image(url) else "#CCCCCC")
-            self.update_audio_motion_gradient(url)
+                                                "#3F3F3F" if light else "#CCCCCC")
+            self.update_audio_motion_gradient(colors)
 
     @PostGui()
-    def update_audio_motion_gradient(self, url=None):
+    def update_audio_motion_gradient(self, colors=None):
         try:
             tags = self.get_current_play_track_info()
             title = tags['name']
-            color_list = get_color(url, title, self.theme_background_rgb_color)
+            color_list = colors
+            if colors is None or len(colors) < 2:
+                color_list = generate_colors(title, self.theme_background_rgb_color)
             self.buffer_widget.eval_js_function("setAudioMotion", color_list)
         except Exception as e:
             log.exception(f'auido motion get color failed: {e}')
 
-    def pick_music_info(self, files):
-        infos = []
-
-        for file in files:
-            file_type = mimetypes.guess_type(file)[0]
-            if file_type and file_type.startswith("audio/"):
-                tags = self.get_audio_taginfos(file)
-                tags['name'] = tags['title']
-                del tags['title']
-                infos.append(tags)
-
-        infos.sort(key=cmp_to_key(self.music_compare))
-        return infos
-
-    def music_compare(self, a, b):
-        if a["artist"] < b["artist"]:
-            return -1
-        elif a["artist"] > b["artist"]:
-            return 1
-        else:
-            if a["album"] < b["album"]:
-                return -1
-            elif a["album"] > b["album"]:
-                return 1
-            else:
-                return 0
-
     def write_tag_info(self, path, name, artist, album):
         audio = taglib.File(path)
         audio.tags['TITLE'] = name
@@ -361,10 +509,33 @@ class AppBuffer(BrowserBuffer):
         audio.tags['ALBUM'] = album
         audio.save()
 
+        # Keep the library index and the in-memory track in sync with the new tags.
+        self.library.update_track(path, name, artist, album)
+        self.local_tracks.update(path, name, artist, album)
+
     def show_tag_info(self):
         info = self.get_current_play_track_info()
         log.debug(f"Tag info: {info['name']} / {info['artist']} / {info['album']} ")
 
+    def purge_lookup_misses(self):
+        count = music_service.purge_misses()
+        message_to_emacs(f"Forgot {count} lyric, cover and song searches that found nothing, they will be searched again")
+
+    def show_provider_stats(self):
+        eval_in_emacs('eaf-music-player-show-provider-stats', [music_service.get_provider_report()])
+
+    def show_cache_stats(self):
+        caches = [('audio', self._netease_backend.get_audio_cache_stats()),
+                  ('cover', self.cover_files.stats()),
+                  ('lyric', self.lyric_files.stats())]
+        message_to_emacs('; '.join(format_cache_stats(name, stats) for name, stats in caches))
+
+    def show_task_stats(self):
+        lanes = self._netease_backend.get_scheduler_stats()
+        message_to_emacs('; '.join([format_lane_stats(lane, stats) for lane, stats in lanes.items()] +
+                                   [f"media {self.media_pool.pending_count()} pending",
+                                    f"prefetch {self.prefetch_pool.pending_count()} pending"]))
+
     def convert_tag_coding(self):
         if not self.is_local_source():
             message_to_emacs('only support local play source')
@@ -375,9 +546,19 @@ class AppBuffer(BrowserBuffer):
         album = self.convert_to_utf8(info["album"])
         track_path = info["path"]
         self.write_tag_info(track_path, name, artist, album)
-        self.buffer_widget.eval_js_function("updateTagInfo", track_path, name, artist, album)
+        self.buffer_widget.eval_js_function("updateTagInfo", self.local_tracks.get_id(track_path), name, artist, album)
         message_to_emacs(f"Convert tag info to: {name} / {artist} / {album}")
 
+    def search_track_forward(self):
+        eval_in_emacs('eaf-music-player-search-track', [self.buffer_id, 'forward'])
+
+    def search_track_backward(self):
+        eval_in_emacs('eaf-music-player-search-track', [self.buffer_id, 'backward'])
+
+    @PostGui()
+    def search_track(self, text, direction):
+        self.buffer_widget.eval_js_function('searchTrack', text, direction == 'backward')
+
     def refresh_cloud_tracks(self):
         log.debug('refresh cloud tracks')
         self._netease_backend.refresh_playlists()
@@ -404,7 +585,7 @@ class AppBuffer(BrowserBuffer):
         album = tag_info[2] if len(tag_info) > 2 else ""
 
         self.write_tag_info(track_path, name, artist, album)
-        self.buffer_widget.eval_js_function("updateTagInfo", track_path, name, artist, album)
+        self.buffer_widget.eval_js_function("updateTagInfo", self.local_tracks.get_id(track_path), name, artist, album)
         message_to_emacs(f"Update tag info: {name} / {artist} / {album}")
 
     def convert_to_utf8(self, gbk_str):
@@ -415,89 +596,163 @@ class AppBuffer(BrowserBuffer):
         except UnicodeDecodeError:
             return gbk_str
 
-class FetchCover(QThread):
-    fetch_result = QtCore.pyqtSignal(str, str)
-    fetch_failed = QtCore.pyqtSignal()
-
-    def __init__(self, track_unikey, cover_cache_dir, artist, title, album, song_id):
-        QThread.__init__(self)
-
-        self.track_unikey = track_unikey
-        self.cover_cache_dir = cover_cache_dir
-        self.artist = artist
-        self.title = title
-        self.album = album
-        self.song_id = song_id
-
-    def run(self):
-        if not os.path.exists(self.cover_cache_dir):
-            os.makedirs(self.cover_cache_dir)
-
-        cover_path = get_cover_path(self.cover_cache_dir, self.artist, self.title)
-
-        if os.path.exists(cover_path):
-            self.fetch_result.emit(self.track_unikey, cover_path)
-        else:
-            result = music_service.fetch_cover(cover_path, self.title, self.artist, self.album, self.song_id)
-            if result:
-                self.fetch_result.emit(self.track_unikey, cover_path)
-            else:
-                log.error(f"Fetch cover name for {self.title} failed.")
-                self.fetch_failed.emit()
-
-class FetchLyric(QThread):
-    fetch_result = QtCore.pyqtSignal(str, str)
+class LibraryScanner(QThread):
+    scan_batch = QtCore.pyqtSignal(list)
+    scan_finished = QtCore.pyqtSignal(list)
 
-    def __init__(self, track_unikey, cache_dir, title, artist, album, song_id):
+    def __init__(self, library, crawler, root, workers):
         QThread.__init__(self)
 
-        self.track_unikey = track_unikey
-        self.lyrics_cache_dir = cache_dir
-        self.title = title
-        self.artist = artist
-        self.album = album
-        self.song_id = song_id
+        self.library = library
+        self.crawler = crawler
+        self.root = root
+        self.workers = workers
+        self.directories = []
 
     def run(self):
-        result = music_service.fetch_lyric(self.title, self.artist, self.album, self.song_id)
-        if result:
-            lyric_path = get_lyric_path(self.lyrics_cache_dir, self.artist, self.title)
-            with open(lyric_path, "w") as f:
-                f.write(result)
-        else:
-            result = '[99:00.000]暂无歌词，请欣赏'
-        self.fetch_result.emit(self.track_unikey, result)
-
+        tracks = []
+        failed = []
+        files = self.crawler.crawl([self.root], self.directories, failed, self.isInterruptionRequested)
+        try:
+            for batch in self.library.scan_batches(self.root, files, self.workers,
+                                                   interrupted=self.isInterruptionRequested,
+                                                   failed_directories=failed):
+                tracks += batch
+                self.scan_batch.emit(batch)
+        finally:
+            # Stops the crawl threads too.
+            files.close()
+        if self.isInterruptionRequested():
+            return
 
-def get_lyric_path(lyrics_cache_dir, artist, title):
-    return normalize_path(os.path.join(lyrics_cache_dir, "{}_{}.lyc".format(artist.replace("/", "_"), title.replace("/", "_"))))
+        # Artists and albums repeat, collate each once.
+        keys = {}
+        def collate(value):
+            key = keys.get(value, None)
+            if key is None:
+                key = keys[value] = collation_key(value)
+            return key
+        tracks.sort(key=lambda track: (collate(track['artist']), collate(track['album'])))
+        self.scan_finished.emit(tracks)
+
+def format_cache_stats(name, stats):
+    limit = f"{stats['max_bytes'] / 1048576:.0f}" if stats['max_bytes'] else 'unlimited'
+    text = f"{name} {stats['files']} files {stats['bytes'] / 1048576:.1f}/{limit} MiB"
+    if stats['pinned_files']:
+        text += f", {stats['pinned_files']} pinned {stats['pinned_bytes'] / 1048576:.1f} MiB"
+    return text + f", {stats['hits']} hits {stats['misses']} misses {stats['evicted']} evicted"
+
+def format_lane_stats(lane, stats):
+    return (f"{lane} {stats['pending']} pending {stats['running']} running {stats['done']} done, "
+            f"wait {stats['avg_wait'] * 1000:.0f} ms avg {stats['max_wait'] * 1000:.0f} ms max")
+
+def fetch_cover_file(cover_files, artist, title, album, song_id):
+    cover_name = get_cover_name(artist, title)
+    cover_path = cover_files.lookup(cover_name)
+    if cover_path:
+        return cover_path
+
+    cover_path = cover_files.get_path(cover_name)
+    if music_service.fetch_cover(cover_path, title, artist, album, song_id):
+        cover_files.add(cover_name)
+        return cover_path
+    log.error(f"Fetch cover name for {title} failed.")
+    return None
+
+def resolve_local_audio_source(infos):
+    return infos['path'], os.path.getsize(infos['path'])
+
+def select_preload_sources(tracks, resolve_source, byte_budget):
+    # Sources of the next tracks in order, as many as fit in the budget.
+    sources = []
+    for track_id, infos in tracks:
+        try:
+            resolved = resolve_source(infos)
+        except OSError as e:
+            log.error(f"resolve preload source of {infos['name']} failed: {e}")
+            resolved = None
+        if not resolved:
+            continue
+        source, size = resolved
+        byte_budget -= size
+        if byte_budget < 0:
+            break
+        sources.append({'id': track_id, 'source': source})
+    return sources
+
+def prefetch_cover(cover_files, cover_cache, artist, title, album, song_id, background_color):
+    cover_path = fetch_cover_file(cover_files, artist, title, album, song_id)
+    if cover_path:
+        analyze_cover(cover_cache, cover_path, background_color)
+
+def fetch_lyric_text(lyric_files, title, artist, album, song_id):
+    lyric_name = get_lyric_name(artist, title)
+    lyric_path = lyric_files.lookup(lyric_name)
+    if lyric_path:
+        with open(lyric_path, "r") as f:
+            return f.read()
+
+    result = music_service.fetch_lyric(title, artist, album, song_id)
+    if result:
+        # Callers that shared one lookup all write the result, replace the file atomically.
+        lyric_path = lyric_files.get_path(lyric_name)
+        temp_path = f'{lyric_path}.{threading.get_ident()}.tmp'
+        with open(temp_path, "w") as f:
+            f.write(result)
+        os.replace(temp_path, lyric_path)
+        lyric_files.add(lyric_name)
+    else:
+        result = '[99:00.000]暂无歌词，请欣赏'
+    return result
+
+def get_lyric_name(artist, title):
+    return "{}_{}.lyc".format(artist.replace("/", "_"), title.replace("/", "_"))
+
+def get_cover_name(artist, title):
+    return "{}_{}.png".format(artist.replace("/", "_"), title.replace("/", "_"))
+
+def load_cover_sample(img, size):
+    # Decode JPEG covers at a reduced scale, then shrink what's left with nearest neighbour,
+    # so the sample keeps real pixel values and its cost doesn't grow with the cover.
+    img.draft('RGB', (size * 2, size * 2))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    if max(img.size) > size:
+        scale = size / max(img.size)
+        img = img.resize((max(int(img.width * scale), 1), max(int(img.height * scale), 1)), Image.Resampling.NEAREST)
+    return img
+
+def analyze_cover(cover_cache, cover_path, background_color):
+    # Covers seen before with the current background need no image work.
+    key = cover_cache.get_key(cover_path)
+    entry = cover_cache.get(key) if key else None
+    if entry is not None:
+        return entry['light'], entry['colors']
 
-def get_cover_path(cover_cache_dir, artist, title):
-    return normalize_path(os.path.join(cover_cache_dir, "{}_{}.png".format(artist.replace("/", "_"), title.replace("/", "_"))))
+    try:
+        colors = get_cover_colors(cover_path, background_color)
+    except Exception as e:
+        log.exception(f'get cover colors failed: {e}')
+        colors = []
+    light = is_light_image(cover_path)
+    if key:
+        cover_cache.put(key, light, colors)
+    return light, colors
 
 def is_light_image(img_path):
     try:
-        img = Image.open(img_path)
-        width, height = img.size
-
-        left = int(width * 0.25)
-        right = int(width * 0.75)
-        top = int(height * 0.25)
-        bottom = int(height * 0.75)
-
-        pixels = []
-        for i in range(top, bottom):
-            for j in range(left, right):
-                pixel = img.getpixel((j, i))
-                pixels.append(pixel)
-
-        light_pixels = 0
-        for pixel in pixels:
-            r, g, b = pixel[:3]
-            if r > 220 or g > 220 or b > 220:
-                light_pixels += 1
-
-        light_pixel_ratio = light_pixels / len(pixels)
+        with Image.open(img_path) as img:
+            img.draft('RGB', (LIGHT_SAMPLE_SIZE * 2, LIGHT_SAMPLE_SIZE * 2))
+            width, height = img.size
+            center = img.crop((int(width * 0.25), int(height * 0.25), int(width * 0.75), int(height * 0.75)))
+            center = load_cover_sample(center, LIGHT_SAMPLE_SIZE)
+
+        # A pixel is light when any channel is above 220.
+        if np is not None:
+            light_pixel_ratio = (np.asarray(center) > 220).any(axis=2).mean()
+        else:
+            pixels = list(center.getdata())
+            light_pixel_ratio = sum(1 for pixel in pixels if max(pixel) > 220) / len(pixels)
         return light_pixel_ratio > 0.45
     except Exception as e:
         log.exception(f'check is light image error: {e}')
@@ -518,50 +773,47 @@ def contrast_ratio(color1, color2):
     l2 = relative_luminance(color2)
     return (l1 + 0.05) / (l2 + 0.05) if l1 > l2 else (l2 + 0.05) / (l1 + 0.05)
 
-def get_color(img_path, title, background_color):
+def get_cover_colors(img_path, background_color):
     results = []
 
-    if img_path:
-        if not os.path.exists(img_path):
-            return []
-        img = Image.open(img_path)
-
-        width, height = img.size
-        colors = img.getcolors(width * height)
-        colors = sorted(colors, key=lambda x: -x[0])
-
-        new_colors = [colors[0]]
-        for color in colors[1:]:
-            is_similar = False
-            for new_color in new_colors:
-                if color_is_similar(color[1], new_color[1], 100):
-                    is_similar = True
-                    break
-
-            if not is_similar:
-                new_colors.append(color)
-
-            if len(new_colors) == 10:
+    with Image.open(img_path) as img:
+        sample = load_cover_sample(img, PALETTE_SAMPLE_SIZE)
+
+    # Quantize the bounded sample, the cost stays flat whatever the cover resolution.
+    quantized = sample.quantize(PALETTE_COLORS, method=Image.Quantize.FASTOCTREE)
+    palette = quantized.getpalette()
+    colors = [(count, tuple(palette[index * 3:index * 3 + 3])) for count, index in quantized.getcolors()]
+    colors = sorted(colors, key=lambda x: -x[0])
+
+    new_colors = [colors[0]]
+    for color in colors[1:]:
+        is_similar = False
+        for new_color in new_colors:
+            if color_is_similar(color[1], new_color[1], 100):
+                is_similar = True
                 break
 
-        sorted_colors = []
-        for count, rgb_color in new_colors:
-            hsl_color = colorsys.rgb_to_hls(rgb_color[0] / 255, rgb_color[1] / 255, rgb_color[2] / 255)
+        if not is_similar:
+            new_colors.append(color)
+
+        if len(new_colors) == 10:
+            break
 
-            # Color won't add to audio gradient if color match below rules:
-            # 1. The color is too bright
-            # 2. The color is too dark
-            # 3. The contrast between the color and the emacs background color is too low
-            if hsl_color[1] > 0.1 and hsl_color[2] > 0.1 and hsl_color[2] < 0.8 and contrast_ratio(rgb_color, background_color) > 2:
-                sorted_colors.append((count, rgb_color, hsl_color))
-        sorted_colors = sorted(sorted_colors, key=lambda x: (x[2][0], -x[2][1], -x[2][2]))
+    sorted_colors = []
+    for count, rgb_color in new_colors:
+        hsl_color = colorsys.rgb_to_hls(rgb_color[0] / 255, rgb_color[1] / 255, rgb_color[2] / 255)
 
-        for count, rgb_color, _ in sorted_colors:
-            hex_color = "#{:02x}{:02x}{:02x}".format(rgb_color[0], rgb_color[1], rgb_color[2])
-            results.append(hex_color)
+        # Color won't add to audio gradient if color match below rules:
+        # 1. The color is too bright
+        # 2. The color is too dark
+        # 3. The contrast between the color and the emacs background color is too low
+        if hsl_color[1] > 0.1 and hsl_color[2] > 0.1 and hsl_color[2] < 0.8 and contrast_ratio(rgb_color, background_color) > 2:
+            sorted_colors.append((count, rgb_color, hsl_color))
+    sorted_colors = sorted(sorted_colors, key=lambda x: (x[2][0], -x[2][1], -x[2][2]))
 
-    if len(results) < 2:
-        results = generate_colors(title, background_color)
+    for count, rgb_color, _ in sorted_colors:
+        hex_color = "#{:02x}{:02x}{:02x}".format(rgb_color[0], rgb_color[1], rgb_color[2])
+        results.append(hex_color)
 
     return results
 
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os.path
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from music_service.utils import get_logger
+
+log = get_logger('CoverCache')
+
+_shared_cover_cache = None
+_shared_cover_cache_lock = threading.Lock()
+
+
+def get_shared_cover_cache(file_path: str, background_color: str) -> 'CoverCache':
+    '''
+    Return the process wide cover cache, opening it on first use. Every
+    buffer must use this one: `put` rewrites the whole file from memory, two
+    instances would erase each other's entries. Later calls only switch the
+    background color.
+    '''
+    global _shared_cover_cache
+    with _shared_cover_cache_lock:
+        if _shared_cover_cache is None:
+            _shared_cover_cache = CoverCache(file_path, background_color)
+        else:
+            _shared_cover_cache.set_background_color(background_color)
+        return _shared_cover_cache
+
+
+class CoverCache:
+    '''
+    Results of the cover analysis, keyed by cover file hash and theme background color.
+
+    An entry holds the light flag used for the lyric color and the cover
+    palette of the audio motion gradient, so a cover already seen needs no
+    image work. The palette is filtered by contrast against the background,
+    entries of other backgrounds are dropped when the theme changes. The
+    least recently used entries go once `max_entries` is reached.
+
+    The cover analysis runs in worker threads, all methods may be called
+    from any thread.
+    '''
+
+    def __init__(self, file_path: str, background_color: str, max_entries: int = 2000):
+        self._file_path = file_path
+        self._background_color = background_color
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        # (path, mtime, size) -> content hash, saves rereading covers played again.
+        self._digests = {}
+        self._lock = threading.Lock()
+
+        self._load()
+
+    def _load(self):
+        if os.path.isfile(self._file_path):
+            try:
+                with open(self._file_path, 'r') as fp:
+                    data = fp.read()
+                self._entries = OrderedDict(json.loads(data))
+            except Exception as e:
+                log.error(f'load cover cache failed: {e}')
+        self._drop_other_backgrounds()
+
+    def _save(self):
+        with open(self._file_path, 'w') as fp:
+            fp.write(json.dumps(self._entries))
+
+    def _drop_other_backgrounds(self) -> bool:
+        suffix = f':{self._background_color}'
+        keys = [key for key in self._entries if not key.endswith(suffix)]
+        for key in keys:
+            del self._entries[key]
+        return len(keys) > 0
+
+    def get_key(self, cover_path: str) -> Optional[str]:
+        try:
+            stat = os.stat(cover_path)
+            file_key = (cover_path, stat.st_mtime_ns, stat.st_size)
+            digest = self._digests.get(file_key, None)
+            if digest is None:
+                with open(cover_path, 'rb') as fp:
+                    digest = hashlib.sha1(fp.read()).hexdigest()
+                with self._lock:
+                    self._digests[file_key] = digest
+        except OSError as e:
+            log.error(f'hash cover {cover_path} failed: {e}')
+            return None
+        with self._lock:
+            return f'{digest}:{self._background_color}'
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, light: bool, colors: list):
+        with self._lock:
+            # Analysed with a background that changed meanwhile.
+            if not key.endswith(f':{self._background_color}'):
+                return
+            self._entries[key] = {'light': light, 'colors': colors}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def set_background_color(self, background_color: str):
+        with self._lock:
+            if background_color == self._background_color:
+                return
+            self._background_color = background_color
+            if self._drop_other_backgrounds():
+                self._save()
@@ -109,11 +109,15 @@
     ("C-m" . "js_sort_by_album")
     ("C-l" . "js_change_panel")
     ("C-u" . "js_toggle_play_source")
-    ("C-s" . "search_text_forward")
-    ("C-r" . "search_text_backward")
+    ("C-s" . "search_track_forward")
+    ("C-r" . "search_track_backward")
     ("F" . "open_link")
     ("e" . "edit_tag_info")
     ("s" . "show_tag_info")
+    ("S" . "show_cache_stats")
+    ("P" . "purge_lookup_misses")
+    ("H" . "show_provider_stats")
+    ("Q" . "show_task_stats")
     ("T" . "convert_tag_coding")
     ("r" . "refresh_cloud_tracks")
     ("p" . "js_playlist_prev")
@@ -137,10 +141,57 @@
   "The default music file or directory."
   :type 'file)
 
+(defcustom eaf-music-scan-workers 0
+  "The number of processes used to read tags of new local music files, 0 means the number of CPU cores.
+Libraries on network file systems mostly wait for the network, more processes than cores read them faster."
+  :type 'integer)
+
+(defcustom eaf-music-watch-poll-interval 30
+  "The interval in seconds to poll music directories that can't be watched with inotify, 0 to disable polling."
+  :type 'integer)
+
+(defcustom eaf-music-prefetch-count 2
+  "The number of tracks coming next in play order whose cover, lyric and url are fetched ahead, 0 to disable."
+  :type 'integer)
+
+(defcustom eaf-music-preload-depth 1
+  "The number of tracks coming next in play order that are buffered ahead for gapless switching, 0 to disable."
+  :type 'integer)
+
+(defcustom eaf-music-preload-bytes (* 64 1024 1024)
+  "The maximum number of bytes of audio buffered ahead for the preloaded tracks."
+  :type 'integer)
+
+(defcustom eaf-music-cover-cache-size (* 200 1024 1024)
+  "The maximum number of bytes of downloaded covers, the least recently used are deleted first, 0 means no limit."
+  :type 'integer)
+
+(defcustom eaf-music-lyric-cache-size (* 20 1024 1024)
+  "The maximum number of bytes of downloaded lyrics, the least recently used are deleted first, 0 means no limit."
+  :type 'integer)
+
+(defcustom eaf-music-provider-race t
+  "Non-nil means lyric, cover and song url providers are queried at once, the first good result is used.
+Otherwise they are tried one after another."
+  :type 'boolean)
+
+(defcustom eaf-music-provider-race-grace 300
+  "The number of milliseconds a preferred provider still running may take after another one has answered."
+  :type 'integer)
+
+(defcustom eaf-music-lookup-miss-ttl (* 7 24 3600)
+  "The number of seconds a lyric, cover or song search that found nothing is not run again, 0 to always search."
+  :type 'integer)
+
 (defcustom eaf-music-cache-dir ""
   "The directory to cache netease music file, default save to music-player/src/cloud_cache/music."
   :type 'string)
 
+(defcustom eaf-music-cache-size (* 2 1024 1024 1024)
+  "The maximum number of bytes of cached netease music files, 0 means no limit.
+Liked songs are never deleted, the others go least recently and least often played first."
+  :type 'integer)
+
 ;;;###autoload
 (defun eaf-open-music-player (&optional music-file)
   "Open EAF music player."
@@ -187,6 +238,24 @@
   "EAF Browser: edit FOCUS-TEXT with Emacs's BUFFER-ID."
   (eaf-edit-buffer-popup buffer-id "eaf-%s-edit-tag-info" "edit-tag-info" (format "%s\n%s\n%s\n" name artist album)))
 
+(defvar eaf-music-player-search-history nil
+  "Text searched in the track list.")
+
+(defun eaf-music-player-search-track (buffer-id direction)
+  "Search the track list of BUFFER-ID in DIRECTION for a title, artist or album.
+Searching the previous text again moves to its next match."
+  (let* ((last (car eaf-music-player-search-history))
+         (text (read-string (if last
+                                (format "Search track %s (default %s): " direction last)
+                              (format "Search track %s: " direction))
+                            nil 'eaf-music-player-search-history last)))
+    (eaf-call-async "execute_function_with_args" buffer-id "search_track" text direction)))
+
+(defun eaf-music-player-show-provider-stats (stats)
+  "Show lyric, cover and song url provider STATS."
+  (with-help-window "*eaf-music-provider-stats*"
+    (princ (if (string= stats "") "No provider has been asked yet." stats))))
+
 (defun eaf-music-player-confirm-tag-info ()
   (eaf-call-async "execute_function_with_args"
                   eaf--buffer-id
@@ -0,0 +1,328 @@
+import os
+import os.path
+from typing import Iterable, List, Optional, Set
+
+from PyQt6.QtCore import QFileSystemWatcher, QObject, QSocketNotifier, QThread, QTimer, pyqtSignal
+
+from music_service.crawler import AudioCrawler
+from music_service.library import MusicLibrary
+from music_service.utils import get_logger
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+logger = get_logger('LibraryWatcher')
+
+DEBOUNCE_INTERVAL = 1000
+
+# How long, in milliseconds, stopping waits for a library thread on the GUI thread.
+STOP_TIMEOUT = 1000
+
+# Threads that didn't stop in time, referenced until they finish,
+# Qt aborts the process when a running QThread is destroyed.
+_stopping_threads: Set[QThread] = set()
+
+
+def stop_thread(thread: QThread, timeout: int = STOP_TIMEOUT):
+    '''Interrupt `thread` and wait at most `timeout` ms, a thread stuck in I/O is left to finish on its own.'''
+    if not thread.isRunning():
+        return
+    thread.requestInterruption()
+    if thread.wait(timeout):
+        return
+    logger.info(f'{thread.__class__.__name__} did not stop in {timeout} ms, let it finish in background')
+    _stopping_threads.add(thread)
+    thread.finished.connect(lambda: _stopping_threads.discard(thread))
+    # It may have finished before the connection.
+    if thread.isFinished():
+        _stopping_threads.discard(thread)
+
+
+def get_directory_signature(directory: str, crawler: AudioCrawler) -> int:
+    '''Hash of the directory mtime and the mtime and size of its audio files, 0 if it can't be read.'''
+    # The directory mtime alone misses tags rewritten in place.
+    files = []
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if crawler.is_audio_file(entry.name):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    files.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    except OSError:
+        return 0
+    return hash((mtime, tuple(sorted(files))))
+
+
+def get_device(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+class InotifyWatcher(QObject):
+    '''
+    Directory watcher on inotify, with the part of the QFileSystemWatcher API
+    LibraryWatcher uses.
+
+    Unlike QFileSystemWatcher it reports files of a directory written in
+    place, e.g. tags rewritten by mutagen or taglib.
+    '''
+
+    directoryChanged = pyqtSignal(str)
+
+    WATCH_FLAGS = (flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO | flags.MODIFY |
+                   flags.CLOSE_WRITE | flags.DELETE_SELF | flags.MOVE_SELF | flags.ONLYDIR) if INotify else 0
+
+    def __init__(self, parent: QObject = None):
+        super().__init__(parent)
+        self._inotify = INotify()
+        # watch descriptor -> directory, and back
+        self._directories = {}
+        self._descriptors = {}
+        self._notifier = QSocketNotifier(self._inotify.fileno(), QSocketNotifier.Type.Read, self)
+        self._notifier.activated.connect(self._read_events)
+
+    def addPaths(self, directories: List[str]) -> List[str]:
+        failed = []
+        for directory in directories:
+            try:
+                wd = self._inotify.add_watch(directory, self.WATCH_FLAGS)
+            except OSError:
+                # Usually the watch limit, fs.inotify.max_user_watches.
+                failed.append(directory)
+                continue
+            self._directories[wd] = directory
+            self._descriptors[directory] = wd
+        return failed
+
+    def removePaths(self, directories: List[str]):
+        for directory in directories:
+            wd = self._descriptors.pop(directory, None)
+            if wd is None:
+                continue
+            del self._directories[wd]
+            try:
+                self._inotify.rm_watch(wd)
+            except OSError:
+                # Already gone with its directory.
+                pass
+
+    def directories(self) -> List[str]:
+        return list(self._descriptors)
+
+    def close(self):
+        self._notifier.setEnabled(False)
+        self._inotify.close()
+
+    def _read_events(self, *_):
+        changed = set()
+        for event in self._inotify.read(timeout=0):
+            if event.mask & flags.Q_OVERFLOW:
+                logger.info('inotify queue overflowed, refresh all watched directories')
+                changed.update(self._descriptors)
+                continue
+            directory = self._directories.get(event.wd, None)
+            if directory is None:
+                continue
+            if event.mask & flags.IGNORED:
+                # The kernel dropped the watch, its directory was removed.
+                del self._directories[event.wd]
+                self._descriptors.pop(directory, None)
+            changed.add(directory)
+        for directory in sorted(changed):
+            self.directoryChanged.emit(directory)
+
+
+class LibraryRefresher(QThread):
+    # changed tracks, removed paths, added directories, removed directories
+    refresh_result = pyqtSignal(list, list, list, list)
+
+    def __init__(self, library: MusicLibrary, crawler: AudioCrawler, root: str, root_device: Optional[int],
+                 directories: List[str], known_directories: Set[str]):
+        super().__init__()
+        self._library = library
+        self._crawler = crawler
+        self._root = root
+        self._root_device = root_device
+        self._directories = directories
+        self._known_directories = known_directories
+
+    def run(self):
+        changed = []
+        removed = []
+        added_dirs = []
+        removed_dirs = []
+
+        # An unmounted library looks like every directory vanished, keep its index.
+        if get_device(self._root) != self._root_device:
+            logger.error(f'music root {self._root} is missing or unmounted, skip refresh')
+            return
+
+        for directory in self._directories:
+            if self.isInterruptionRequested():
+                return
+
+            # Children that vanished, including `directory` itself, drop everything below them.
+            for known in self._known_directories:
+                if (known == directory or os.path.dirname(known) == directory) and not os.path.isdir(known):
+                    removed += self._library.forget(known)
+                    removed_dirs += [d for d in self._known_directories
+                                     if d == known or d.startswith(os.path.join(known, ''))]
+            if not os.path.isdir(directory):
+                continue
+
+            files = []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            if entry.path not in self._known_directories:
+                                # A new subdirectory, e.g. an album copied in, is crawled whole.
+                                sub_dirs = []
+                                failed = []
+                                tracks, paths = self._library.refresh(entry.path,
+                                                                      self._crawler.crawl([entry.path], sub_dirs, failed,
+                                                                                          self.isInterruptionRequested),
+                                                                      interrupted=self.isInterruptionRequested,
+                                                                      failed_directories=failed)
+                                changed += tracks
+                                removed += paths
+                                added_dirs += sub_dirs
+                        elif self._crawler.is_audio_file(entry.name) and entry.is_file():
+                            files.append(entry.path)
+            except OSError as e:
+                logger.error(f'refresh directory {directory} failed: {e}')
+                continue
+
+            tracks, paths = self._library.refresh(directory, files, recursive=False,
+                                                  interrupted=self.isInterruptionRequested)
+            changed += tracks
+            removed += paths
+
+        if not self.isInterruptionRequested():
+            self.refresh_result.emit(changed, removed, added_dirs, removed_dirs)
+
+
+class LibraryWatcher(QObject):
+    '''
+    Watch the directories of the local library and report track deltas.
+
+    Directories are watched with inotify_simple when it is installed, which
+    also reports tags rewritten in place; otherwise QFileSystemWatcher only
+    reports files added, removed or renamed. Directories that can't be
+    watched, for example once the inotify watch limit is reached, are polled
+    every `poll_interval` seconds instead, comparing the mtime and size of
+    their audio files. Events are debounced, then only the changed
+    directories are rescanned through the library index.
+    '''
+
+    # changed tracks, removed paths
+    tracks_changed = pyqtSignal(list, list)
+
+    def __init__(self, library: MusicLibrary, crawler: AudioCrawler, root: str,
+                 directories: Iterable[str], poll_interval: int):
+        super().__init__()
+        self._library = library
+        self._crawler = crawler
+        self._root = root
+        self._root_device = get_device(root)
+        self._directories = set()
+        self._polled_directories = {}
+        self._dirty_directories = set()
+        self._refresher = None
+
+        self._watcher = InotifyWatcher(self) if INotify is not None else QFileSystemWatcher(self)
+        self._watcher.directoryChanged.connect(self._on_directory_changed)
+
+        self._debounce_timer = QTimer(self)
+        self._debounce_timer.setSingleShot(True)
+        self._debounce_timer.setInterval(DEBOUNCE_INTERVAL)
+        self._debounce_timer.timeout.connect(self._refresh)
+
+        self._poll_timer = QTimer(self)
+        self._poll_timer.setInterval(max(poll_interval, 1) * 1000)
+        self._poll_timer.timeout.connect(self._poll)
+        self._poll_enabled = poll_interval > 0
+
+        self._add_directories(directories)
+
+    def _add_directories(self, directories: Iterable[str]):
+        directories = [d for d in directories if d not in self._directories]
+        if not directories:
+            return
+
+        self._directories.update(directories)
+        failed = self._watcher.addPaths(directories)
+        for directory in failed:
+            self._polled_directories[directory] = get_directory_signature(directory, self._crawler)
+
+        if failed and self._poll_enabled and not self._poll_timer.isActive():
+            logger.info(f'{len(failed)} directories can not be watched, poll them instead')
+            self._poll_timer.start()
+
+    def stop(self):
+        '''Stop watching and interrupt the running refresh.'''
+        self._debounce_timer.stop()
+        self._poll_timer.stop()
+        watched = self._watcher.directories()
+        if watched:
+            self._watcher.removePaths(watched)
+        if isinstance(self._watcher, InotifyWatcher):
+            self._watcher.close()
+        if self._refresher:
+            # Its result must not reach a watcher that is gone.
+            self._refresher.refresh_result.disconnect(self._handle_refresh_result)
+            stop_thread(self._refresher)
+
+    def _remove_directories(self, directories: Iterable[str]):
+        directories = [d for d in directories if d in self._directories]
+        if not directories:
+            return
+
+        self._directories.difference_update(directories)
+        watched = set(self._watcher.directories())
+        watched_directories = [d for d in directories if d in watched]
+        if watched_directories:
+            self._watcher.removePaths(watched_directories)
+        for directory in directories:
+            self._polled_directories.pop(directory, None)
+
+    def _on_directory_changed(self, directory: str):
+        self._dirty_directories.add(directory)
+        self._debounce_timer.start()
+
+    def _poll(self):
+        for directory, signature in list(self._polled_directories.items()):
+            new_signature = get_directory_signature(directory, self._crawler)
+            if new_signature != signature:
+                self._polled_directories[directory] = new_signature
+                self._on_directory_changed(directory)
+
+    def _refresh(self):
+        # Wait for the running refresh, events keep piling up meanwhile.
+        if self._refresher and self._refresher.isRunning():
+            self._debounce_timer.start()
+            return
+
+        directories = sorted(self._dirty_directories)
+        self._dirty_directories.clear()
+        logger.debug(f'refresh changed directories: {directories}')
+
+        self._refresher = LibraryRefresher(self._library, self._crawler, self._root, self._root_device,
+                                           directories, set(self._directories))
+        self._refresher.refresh_result.connect(self._handle_refresh_result)
+        self._refresher.start()
+
+    def _handle_refresh_result(self, changed, removed, added_dirs, removed_dirs):
+        self._remove_directories(removed_dirs)
+        self._add_directories(added_dirs)
+        if changed or removed:
+            logger.debug(f'library changed, {len(changed)} tracks updated, {len(removed)} removed')
+            self.tracks_changed.emit(changed, removed)
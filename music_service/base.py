@@ -1,8 +1,17 @@
-from typing import Optional
+from typing import Any, Callable, Optional
+
+from music_service.search_memo import SearchMemo
 
 
 class BaseProvider:
     provider_name: str = ''
+    # Set by `MusicService.set_search_memo`.
+    search_memo: Optional[SearchMemo] = None
+
+    def memoized_search(self, name: str, artist: str, search: Callable[[], Any]) -> Any:
+        if self.search_memo is None:
+            return search()
+        return self.search_memo.resolve(self.provider_name, name, artist, search)
 
     def fetch_lyric(self, name: str, artist: str = '', album: str = '', song_id: int = 0) -> Optional[str]:
         raise NotImplementedError()
@@ -0,0 +1,26 @@
+try:
+    from pypinyin import lazy_pinyin
+except ImportError:
+    lazy_pinyin = None
+
+
+def collation_key(value: str) -> str:
+    '''
+    Return a sort key for a track name, artist or album.
+
+    Empty values sort first, then values starting with an ASCII character,
+    case-insensitively, then everything else. CJK values are ordered by
+    pinyin when pypinyin is installed, by code point otherwise. Keys are
+    plain strings, they compare much faster than tuples.
+    '''
+    value = value.strip() if value else ''
+    if not value:
+        return '0'
+
+    folded = value.casefold()
+    if ord(value[0]) <= 128:
+        return '1' + folded
+    if lazy_pinyin is None:
+        return '2' + folded
+    # \x01 ends each syllable so that "a" sorts before "ai".
+    return '2' + ''.join(syllable.casefold() + '\x01' for syllable in lazy_pinyin(value)) + '\x00' + folded
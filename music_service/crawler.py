@@ -0,0 +1,192 @@
+import mimetypes
+import os.path
+import queue
+import threading
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from music_service.utils import get_logger
+
+log = get_logger('AudioCrawler')
+
+
+# How often, in seconds, a parallel crawl waiting on a slow directory checks for interruption.
+INTERRUPT_POLL_INTERVAL = 0.1
+
+# Common formats the system mime database may not list.
+DEFAULT_AUDIO_EXTENSIONS = ('.mp3', '.flac', '.ogg', '.opus', '.m4a', '.aac', '.wav', '.ape', '.wma')
+
+
+def get_audio_extensions(extra_extensions: Iterable[str] = ()) -> frozenset:
+    '''Return the extensions mimetypes knows as audio, plus `extra_extensions`.'''
+    if not mimetypes.inited:
+        mimetypes.init()
+    extensions = {ext.lower() for ext, file_type in mimetypes.types_map.items() if file_type.startswith('audio/')}
+    extensions.update(DEFAULT_AUDIO_EXTENSIONS)
+    extensions.update('.' + ext.lower().lstrip('.') for ext in extra_extensions)
+    return frozenset(extensions)
+
+
+class AudioCrawler:
+    '''
+    Find audio files below one or several roots with os.scandir.
+
+    Files are filtered by extension before anything else, so images, cue
+    sheets and logs next to the music cost no stat call. Symlinked
+    directories are followed once, links that point back to an ancestor or
+    into a crawled root are skipped. With more than one worker, directories
+    are listed by a thread pool, which keeps several requests in flight on
+    network file systems.
+    '''
+
+    def __init__(self, extensions: Iterable[str], workers: int = 4):
+        self._extensions = frozenset(extensions)
+        self._workers = workers
+
+    def is_audio_file(self, path: str) -> bool:
+        return os.path.splitext(path)[1].lower() in self._extensions
+
+    def crawl(self, roots: List[str], directories: Optional[List[str]] = None,
+              failed: Optional[List[str]] = None,
+              interrupted: Optional[Callable[[], bool]] = None) -> Iterator[str]:
+        '''
+        Yield audio files below `roots`, collecting the crawled directories in
+        `directories`, and the roots that don't exist and directories that
+        could not be listed in `failed`. The crawl stops early once
+        `interrupted` returns True, it is checked before every directory.
+        '''
+        if interrupted is None:
+            interrupted = lambda: False
+
+        root_dirs = []
+        for root in roots:
+            if os.path.isdir(root):
+                root_dirs.append(root)
+            elif os.path.isfile(root):
+                if self.is_audio_file(root):
+                    yield root
+            elif failed is not None:
+                log.error(f'music root {root} is missing')
+                failed.append(root)
+
+        links = _SymlinkGuard(root_dirs)
+        if self._workers <= 1:
+            results = self._crawl_serial(root_dirs, links, interrupted)
+        else:
+            results = self._crawl_parallel(root_dirs, links, interrupted)
+
+        try:
+            for directory, files in results:
+                if interrupted():
+                    log.debug(f'crawl {roots} interrupted')
+                    return
+                if directories is not None:
+                    directories.append(directory)
+                if files is None:
+                    if failed is not None:
+                        failed.append(directory)
+                    continue
+                yield from files
+        finally:
+            # Stops the crawl threads now rather than when the generator is collected.
+            results.close()
+
+    def _crawl_serial(self, root_dirs: List[str], links: '_SymlinkGuard',
+                      interrupted: Callable[[], bool]) -> Iterator[Tuple[str, Optional[List[str]]]]:
+        stack = list(reversed(root_dirs))
+        while stack and not interrupted():
+            directory = stack.pop()
+            files, subdirs = self._scan_directory(directory, links)
+            stack += reversed(subdirs)
+            yield directory, files
+
+    def _crawl_parallel(self, root_dirs: List[str], links: '_SymlinkGuard',
+                        interrupted: Callable[[], bool]) -> Iterator[Tuple[str, Optional[List[str]]]]:
+        if not root_dirs:
+            return
+
+        directory_queue = queue.Queue()
+        result_queue = queue.Queue()
+        stop_event = threading.Event()
+        pending = [len(root_dirs)]
+        pending_lock = threading.Lock()
+
+        def work():
+            while True:
+                directory = directory_queue.get()
+                if directory is None or stop_event.is_set() or interrupted():
+                    return
+
+                files, subdirs = self._scan_directory(directory, links)
+                # Count subdirectories before this one is done, so pending never drops to 0 early.
+                with pending_lock:
+                    pending[0] += len(subdirs)
+                for subdir in subdirs:
+                    directory_queue.put(subdir)
+                result_queue.put((directory, files))
+                with pending_lock:
+                    pending[0] -= 1
+                    if pending[0] == 0:
+                        result_queue.put(None)
+
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(self._workers)]
+        for root in root_dirs:
+            directory_queue.put(root)
+        for thread in threads:
+            thread.start()
+
+        try:
+            while not interrupted():
+                # Wake up now and then, a hung directory must not hide the interruption.
+                try:
+                    result = result_queue.get(timeout=INTERRUPT_POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                if result is None:
+                    break
+                yield result
+        finally:
+            stop_event.set()
+            for _ in threads:
+                directory_queue.put(None)
+
+    def _scan_directory(self, directory: str, links: '_SymlinkGuard') -> Tuple[Optional[List[str]], List[str]]:
+        '''Return the audio files and subdirectories of `directory`, files is None if it can't be listed.'''
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if self.is_audio_file(entry.name) and entry.is_file():
+                            files.append(entry.path)
+                        elif entry.is_dir():
+                            if not entry.is_symlink() or links.follow(entry.path):
+                                subdirs.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError as e:
+            log.error(f'scan directory {directory} failed: {e}')
+            return None, []
+        return files, subdirs
+
+
+class _SymlinkGuard:
+    '''Decide which symlinked directories of one crawl are followed.'''
+
+    def __init__(self, root_dirs: List[str]):
+        self._lock = threading.Lock()
+        self._real_roots = [os.path.join(os.path.realpath(root), '') for root in root_dirs]
+        self._visited = set(self._real_roots)
+
+    def follow(self, path: str) -> bool:
+        real_path = os.path.join(os.path.realpath(path), '')
+        real_parent = os.path.join(os.path.realpath(os.path.dirname(path)), '')
+        with self._lock:
+            # Already crawled through another link, or a loop back to an ancestor.
+            if real_path in self._visited or real_parent.startswith(real_path):
+                return False
+            # Inside a crawled root, the plain crawl reaches it anyway.
+            if any(real_path.startswith(root) for root in self._real_roots):
+                return False
+            self._visited.add(real_path)
+        return True
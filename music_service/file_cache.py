@@ -0,0 +1,217 @@
+import hashlib
+import os
+import os.path
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional
+
+from music_service.utils import get_db_cache_file, get_logger, normalize_path
+
+log = get_logger('FileCache')
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+def get_shared_cache(name: str, root_dir: str, max_bytes: int = 0, extension: str = '',
+                     play_weight: float = 0) -> 'FileCache':
+    '''
+    Return the process wide cache `name`, indexed in `<name>.db`, opening it
+    on first use. Every buffer must use this one: each FileCache keeps its own
+    totals, two over the same directory would miss each other's files and
+    evict on wrong sizes. Arguments of later calls are ignored.
+    '''
+    with _shared_caches_lock:
+        cache = _shared_caches.get(name, None)
+        if cache is None:
+            cache = _shared_caches[name] = FileCache(root_dir, get_db_cache_file(f'{name}.db'), max_bytes,
+                                                     extension, play_weight)
+        return cache
+
+
+class FileCache:
+    '''
+    Size-capped directory of cached files, evicting the least recently used.
+
+    Files live in subdirectories named after the first hash byte of their
+    name, so no directory grows past a few hundred entries. Size, last use
+    and play count of every file are kept in a SQLite index: lookups and
+    eviction never list the directories. Files ending with `extension` left
+    flat in `root_dir` by older versions are moved into their subdirectories
+    on open.
+
+    With a `play_weight`, every recorded play counts as that many seconds of
+    recency, so often played files outlive files used once more recently.
+    Pinned files are never evicted.
+
+    Writers store the file at `get_path(name)` and then call `add(name)`.
+    All methods may be called from any thread.
+    '''
+
+    # Last-use updates are written to the index in batches of this many.
+    TOUCH_BATCH = 32
+
+    def __init__(self, root_dir: str, db_file: str, max_bytes: int = 0, extension: str = '', play_weight: float = 0):
+        self._root_dir = root_dir
+        self._max_bytes = max_bytes
+        self._extension = extension
+        self._play_weight = play_weight
+        self._touched = {}
+        self._pinned = set()
+        self._hits = 0
+        self._misses = 0
+        self._evicted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        # Losing the last few updates on a crash only ages some files, don't wait for the disk.
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                           'name TEXT PRIMARY KEY, '
+                           'size INTEGER NOT NULL, '
+                           'atime REAL NOT NULL, '
+                           'plays INTEGER NOT NULL DEFAULT 0)')
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(files)')]
+        if 'plays' not in columns:
+            self._conn.execute('ALTER TABLE files ADD COLUMN plays INTEGER NOT NULL DEFAULT 0')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS files_atime ON files (atime)')
+        self._conn.commit()
+        # name -> size, lookups don't touch the index.
+        self._sizes = dict(self._conn.execute('SELECT name, size FROM files'))
+        self._total = sum(self._sizes.values())
+
+        os.makedirs(root_dir, exist_ok=True)
+        self._adopt_flat_files()
+
+    def _adopt_flat_files(self):
+        with os.scandir(self._root_dir) as entries:
+            names = [entry.name for entry in entries if entry.is_file() and entry.name.endswith(self._extension)]
+        if not names:
+            return
+
+        rows = []
+        for name in names:
+            try:
+                path = self.get_path(name)
+                os.replace(os.path.join(self._root_dir, name), path)
+                stat = os.stat(path)
+            except OSError as e:
+                log.error(f'move {name} into {self._root_dir} shards failed: {e}')
+                continue
+            # Last modified is the best guess of last use for files never indexed.
+            rows.append((name, stat.st_size, stat.st_mtime))
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO files (name, size, atime) VALUES (?, ?, ?)', rows)
+            for name, size, _ in rows:
+                self._total += size - self._sizes.get(name, 0)
+                self._sizes[name] = size
+            # Eviction waits for the next add, pinned names aren't known yet.
+            self._conn.commit()
+        log.debug(f'moved {len(rows)} files into {self._root_dir} shards')
+
+    def _path(self, name: str) -> str:
+        shard = hashlib.sha1(name.encode('utf-8')).hexdigest()[:2]
+        return normalize_path(os.path.join(self._root_dir, shard, name))
+
+    def get_path(self, name: str) -> str:
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            return name in self._sizes
+
+    def lookup(self, name: str) -> Optional[str]:
+        '''Return the path of `name` if it is cached and mark it used.'''
+        with self._lock:
+            if name not in self._sizes:
+                self._misses += 1
+                return None
+            path = self._path(name)
+            # Removed behind our back.
+            if not os.path.exists(path):
+                self._conn.execute('DELETE FROM files WHERE name = ?', (name,))
+                self._conn.commit()
+                self._total -= self._sizes.pop(name)
+                self._touched.pop(name, None)
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._touched[name] = time.time()
+            if len(self._touched) >= self.TOUCH_BATCH:
+                self._flush_touched()
+            return path
+
+    def add(self, name: str):
+        '''Index the file just written at `get_path(name)`, evict others if over the cap.'''
+        try:
+            size = os.path.getsize(self._path(name))
+        except OSError as e:
+            log.error(f'add {name} to cache failed: {e}')
+            return
+        with self._lock:
+            self._total += size - self._sizes.get(name, 0)
+            self._sizes[name] = size
+            self._conn.execute('INSERT INTO files (name, size, atime) VALUES (?, ?, ?) '
+                               'ON CONFLICT (name) DO UPDATE SET size = excluded.size, atime = excluded.atime',
+                               (name, size, time.time()))
+            self._touched.pop(name, None)
+            self._evict(keep=name)
+            self._conn.commit()
+
+    def record_play(self, name: str):
+        with self._lock:
+            if name in self._sizes:
+                self._conn.execute('UPDATE files SET plays = plays + 1 WHERE name = ?', (name,))
+                self._conn.commit()
+
+    def set_pinned(self, names: Iterable[str]):
+        '''Keep `names` whatever the cap, replacing the previous pinned set.'''
+        with self._lock:
+            self._pinned = set(names)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pinned = [name for name in self._pinned if name in self._sizes]
+            return {'files': len(self._sizes),
+                    'bytes': self._total,
+                    'max_bytes': self._max_bytes,
+                    'pinned_files': len(pinned),
+                    'pinned_bytes': sum(self._sizes[name] for name in pinned),
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evicted': self._evicted}
+
+    def _flush_touched(self):
+        self._conn.executemany('UPDATE files SET atime = ? WHERE name = ?',
+                               [(atime, name) for name, atime in self._touched.items()])
+        self._conn.commit()
+        self._touched.clear()
+
+    def _evict(self, keep: str):
+        if self._max_bytes <= 0 or self._total <= self._max_bytes:
+            return
+        self._flush_touched()
+        rows = self._conn.execute('SELECT name, size FROM files WHERE name != ? ORDER BY atime + plays * ?',
+                                  (keep, self._play_weight))
+        evicted = []
+        for name, size in rows:
+            if self._total <= self._max_bytes:
+                break
+            if name in self._pinned:
+                continue
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.error(f'evict {name} failed: {e}')
+                continue
+            self._total -= size
+            del self._sizes[name]
+            evicted.append((name,))
+        self._conn.executemany('DELETE FROM files WHERE name = ?', evicted)
+        self._evicted += len(evicted)
+        log.debug(f'evicted {len(evicted)} files from {self._root_dir}, {self._total} bytes left')
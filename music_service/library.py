@@ -0,0 +1,291 @@
+import multiprocessing
+import os.path
+import sqlite3
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import taglib
+
+from music_service.utils import get_logger
+
+try:
+    from mutagen.easyid3 import EasyID3
+except ImportError:
+    EasyID3 = None
+
+log = get_logger('MusicLibrary')
+
+# The pool is created in the middle of a scan, forking the threads of this
+# process then can leave a child stuck on a lock some other thread held.
+# Start the workers from a clean process instead, forkserver isn't on Windows.
+_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def _get_tag_value(tags, key: str) -> str:
+    values = tags.get(key, None)
+    if not values:
+        return ''
+    return values[0]
+
+def read_audio_tags(file_path: str) -> dict:
+    tags = taglib.File(file_path).tags
+    title_key = 'TITLE'
+    artist_key = 'ARTIST'
+    album_key = 'ALBUM'
+    if not _get_tag_value(tags, title_key):
+        if EasyID3 is not None:
+            try:
+                tags = EasyID3(file_path)
+                title_key = title_key.lower()
+                artist_key = artist_key.lower()
+                album_key = album_key.lower()
+            except Exception:
+                pass
+    title = _get_tag_value(tags, title_key)
+    if not title:
+        title = os.path.splitext(os.path.basename(file_path))[0]
+    return {
+        'path': file_path,
+        'name': title,
+        'artist': _get_tag_value(tags, artist_key),
+        'album': _get_tag_value(tags, album_key)
+    }
+
+def read_audio_tags_batch(files: List[str]) -> List[Optional[dict]]:
+    results = []
+    for path in files:
+        try:
+            results.append(read_audio_tags(path))
+        except Exception as e:
+            log.error(f'read tags of {path} failed: {e}')
+            results.append(None)
+    return results
+
+class TagExtractor:
+    '''
+    Read tags of files added one by one, serially or in a process pool.
+
+    Files are grouped in batches of `batch_size`. With more than one worker the
+    batches are read in a process pool, at most two batches per worker are in
+    flight so huge libraries don't queue every path up front. Unreadable files
+    are skipped.
+
+    Batches of 64 balance inter-process traffic against workers left idle
+    at the end of a scan.
+    '''
+
+    def __init__(self, workers: int = 1, batch_size: int = 64):
+        self._workers = workers
+        self._batch_size = batch_size
+        self._batch = []
+        self._pending = set()
+        self._executor = None
+
+    def add(self, path: str) -> List[dict]:
+        '''Queue `path` and return the tag infos that finished reading meanwhile.'''
+        self._batch.append(path)
+        if len(self._batch) < self._batch_size:
+            return []
+        return self._submit()
+
+    def finish(self) -> List[dict]:
+        '''Return the tag infos of all remaining files.'''
+        infos = self._submit()
+        if self._pending:
+            done, self._pending = wait(self._pending)
+            infos += self._collect(done)
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+        return infos
+
+    def close(self):
+        '''Drop the remaining files, batches already being read finish in the background.'''
+        self._batch = []
+        self._pending = set()
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _submit(self) -> List[dict]:
+        batch, self._batch = self._batch, []
+        if not batch:
+            return []
+
+        # Small scans stay in-process, spawning the pool costs more than reading a few files.
+        if self._workers <= 1 or (not self._executor and len(batch) < self._batch_size):
+            return [info for info in read_audio_tags_batch(batch) if info]
+
+        if not self._executor:
+            self._executor = ProcessPoolExecutor(max_workers=self._workers,
+                                                 mp_context=multiprocessing.get_context(_START_METHOD))
+        self._pending.add(self._executor.submit(read_audio_tags_batch, batch))
+        if len(self._pending) >= self._workers * 2:
+            done, self._pending = wait(self._pending, return_when=FIRST_COMPLETED)
+        else:
+            done = {future for future in self._pending if future.done()}
+            self._pending -= done
+        return self._collect(done)
+
+    def _collect(self, futures) -> List[dict]:
+        return [info for future in futures for info in future.result() if info]
+
+
+class MusicLibrary:
+    '''
+    Persistent tag index of local music files.
+
+    Every row is keyed by path and remembers the mtime and size the tags were
+    read at, so a rescan only opens files that are new or have changed.
+    '''
+
+    def __init__(self, db_file: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS tracks ('
+                           'path TEXT PRIMARY KEY, '
+                           'mtime INTEGER NOT NULL, '
+                           'size INTEGER NOT NULL, '
+                           'name TEXT NOT NULL, '
+                           'artist TEXT NOT NULL, '
+                           'album TEXT NOT NULL)')
+        self._conn.commit()
+
+    def _load(self, root: str, recursive: bool = True) -> Dict[str, tuple]:
+        prefix = os.path.join(root, '')
+        # Paths below `root` sort between "root/" and "root0", whatever characters follow.
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        with self._lock:
+            rows = self._conn.execute('SELECT path, mtime, size, name, artist, album FROM tracks '
+                                      'WHERE path = ? OR (path >= ? AND path < ?)',
+                                      (root, prefix, end)).fetchall()
+        if not recursive:
+            rows = [row for row in rows if row[0] == root or os.path.dirname(row[0]) == root]
+        return {row[0]: row for row in rows}
+
+    def _save(self, changed: List[tuple], removed: List[str]):
+        if not changed and not removed:
+            return
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)', changed)
+            self._conn.executemany('DELETE FROM tracks WHERE path = ?', [(path,) for path in removed])
+            self._conn.commit()
+
+    def _scan(self, root: str, files: Iterable[str], workers: int, batch_size: int,
+              recursive: bool, removed_paths: List[str],
+              interrupted: Optional[Callable[[], bool]] = None,
+              failed_directories: Iterable[str] = ()) -> Iterator[Tuple[List[dict], List[dict]]]:
+        '''Yield batches of (tag infos of `files`, tag infos that were read from disk).'''
+        cached = self._load(root, recursive)
+        extractor = TagExtractor(workers)
+        stats = {}
+        changed = []
+        batch = []
+        read_infos = []
+        total = read = 0
+
+        def index_infos(infos):
+            for info in infos:
+                stat = stats.pop(info['path'])
+                changed.append((info['path'], stat.st_mtime_ns, stat.st_size,
+                                info['name'], info['artist'], info['album']))
+            read_infos.extend(infos)
+            return infos
+
+        for path in files:
+            if interrupted is not None and interrupted():
+                extractor.close()
+                # Only what was read so far, the unvisited rest is no sign of removal.
+                self._save(changed, [])
+                log.debug(f'library scan {root} interrupted after {total} tracks')
+                return
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            row = cached.pop(path, None)
+            if row and row[1] == stat.st_mtime_ns and row[2] == stat.st_size:
+                batch.append({'path': path, 'name': row[3], 'artist': row[4], 'album': row[5]})
+            else:
+                stats[path] = stat
+                batch += index_infos(extractor.add(path))
+
+            if len(batch) >= batch_size:
+                total += len(batch)
+                read += len(changed)
+                self._save(changed, [])
+                yield batch, read_infos
+                changed = []
+                batch = []
+                read_infos = []
+
+        batch += index_infos(extractor.finish())
+        total += len(batch)
+        read += len(changed)
+        # What wasn't seen may just be unreachable, only drop files whose directory was listed.
+        if os.path.exists(root):
+            failed = [os.path.join(directory, '') for directory in failed_directories]
+            removed_paths.extend(path for path in cached if not path.startswith(tuple(failed)))
+        else:
+            log.error(f'library root {root} is missing, keep its index')
+        self._save(changed, removed_paths)
+        if batch or read_infos:
+            yield batch, read_infos
+        log.debug(f'library scan {root}: {total} tracks, {read} read, {len(removed_paths)} removed')
+
+    def scan_batches(self, root: str, files: Iterable[str], workers: int = 1, batch_size: int = 256,
+                     interrupted: Optional[Callable[[], bool]] = None,
+                     failed_directories: Iterable[str] = ()) -> Iterator[List[dict]]:
+        '''
+        Yield the tag infos of `files` in batches as soon as they are known,
+        reading tags only for files that are not indexed yet or whose
+        mtime/size changed.
+
+        `files` may be a lazy iterable, so batches start before the crawl of
+        `root` is done. Indexed files under `root` that are not in `files` any
+        more are dropped once the scan finishes, except those below
+        `failed_directories`, read at the end of the scan, and all of them
+        when `root` is missing: an unmounted or unreachable library keeps its
+        index.
+
+        The scan stops early once `interrupted()` returns true, nothing is
+        dropped then.
+        '''
+        for batch, _ in self._scan(root, files, workers, batch_size, True, [], interrupted, failed_directories):
+            yield batch
+
+    def refresh(self, root: str, files: Iterable[str], recursive: bool = True,
+                interrupted: Optional[Callable[[], bool]] = None,
+                failed_directories: Iterable[str] = ()) -> Tuple[List[dict], List[str]]:
+        '''
+        Rescan `root` and return the tag infos of new or changed files, and
+        the paths dropped from the index.
+
+        With `recursive` false only files directly in `root` are compared, so
+        one directory can be refreshed without crawling its subdirectories.
+        Files that can't be reached are kept, see `scan_batches`.
+        '''
+        changed = []
+        removed = []
+        for _, read_infos in self._scan(root, files, 1, 256, recursive, removed, interrupted, failed_directories):
+            changed += read_infos
+        return changed, removed
+
+    def forget(self, root: str) -> List[str]:
+        '''Drop `root` and everything indexed below it, return the dropped paths.'''
+        removed = list(self._load(root))
+        self._save([], removed)
+        return removed
+
+    def update_track(self, path: str, name: str, artist: str, album: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)',
+                               (path, stat.st_mtime_ns, stat.st_size, name, artist, album))
+            self._conn.commit()
@@ -0,0 +1,67 @@
+import json
+import os.path
+import threading
+import time
+from typing import Tuple
+
+from music_service.utils import get_logger
+
+log = get_logger('MissCache')
+
+
+class MissCache:
+    '''
+    Lookups every provider answered without a result, persisted as JSON.
+
+    Keys are tuples of strings such as ('lyric', artist, title), already
+    normalized by the caller. An entry is forgotten `ttl` seconds after it
+    was added, so tracks that get lyrics or covers online later are looked
+    up again. Lookups that failed with an error are not misses, callers
+    only add keys all providers answered for.
+    '''
+
+    def __init__(self, file_path: str, ttl: float):
+        self._file_path = file_path
+        self._ttl = ttl
+        # key -> time added
+        self._entries = {}
+        self._lock = threading.Lock()
+
+        self._load()
+
+    def _load(self):
+        if os.path.isfile(self._file_path):
+            try:
+                with open(self._file_path, 'r') as fp:
+                    data = fp.read()
+                now = time.time()
+                self._entries = {key: added for key, added in json.loads(data).items() if now - added < self._ttl}
+            except Exception as e:
+                log.error(f'load miss cache failed: {e}')
+
+    def _save(self):
+        with open(self._file_path, 'w') as fp:
+            fp.write(json.dumps(self._entries))
+
+    @staticmethod
+    def _encode(key: Tuple[str, ...]) -> str:
+        return '\x00'.join(key)
+
+    def is_miss(self, key: Tuple[str, ...]) -> bool:
+        with self._lock:
+            added = self._entries.get(self._encode(key), None)
+            return added is not None and time.time() - added < self._ttl
+
+    def add(self, key: Tuple[str, ...]):
+        with self._lock:
+            now = time.time()
+            self._entries = {key: added for key, added in self._entries.items() if now - added < self._ttl}
+            self._entries[self._encode(key)] = now
+            self._save()
+
+    def purge(self) -> int:
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._save()
+            return count
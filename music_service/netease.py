@@ -134,7 +134,7 @@ class NeteaseMusicApi(BaseProvider):
 
     def fetch_lyric(self, name: str, artist: str = '', album: str = '', song_id: int = 0) -> Optional[str]:
         if song_id == 0:
-            song_id = self.get_song_id(name, artist, album, fuzzy=False)
+            song_id = self.search_song_id(name, artist, album)
         if not song_id:
             return None
         lyric_result = self.api_lyric(song_id)
@@ -142,7 +142,7 @@ class NeteaseMusicApi(BaseProvider):
 
     def fetch_cover(self, name: str, artist: str = '', album: str = '', song_id: int = 0) -> Optional[str]:
         if song_id == 0:
-            song_id = self.get_song_id(name, artist, album, fuzzy=False)
+            song_id = self.search_song_id(name, artist, album)
         if not song_id:
             return None
         result = self.api_song_detail(song_id)
@@ -154,9 +154,16 @@ class NeteaseMusicApi(BaseProvider):
             return f'{url}?param=200y200'
         return None
 
+    def search_song_id(self, name: str, artist: str = '', album: str = '') -> Optional[int]:
+        '''Return the id of the exact match, for tracks without one such as local files, searched once per track.'''
+        return self.memoized_search(name, artist, lambda: self.get_song_id(name, artist, album, fuzzy=False) or None)
+
     def get_song_id(self, name: str, artist: str = '', album: str = '', fuzzy: bool = True) -> Optional[int]:
         keywords = f'{name} {artist}'.strip()
         search_result = self.api_search_song(keywords)
+        # A rejected request found nothing yet, don't take it for an answer.
+        if search_result.get('code', 200) != 200:
+            raise IOError(f'search {keywords} failed: {search_result}')
         songs = search_result.get('result', {}).get('songs', None)
         if not songs:
             return None
@@ -12,11 +12,7 @@ class QQMusicApi(BaseProvider):
     provider_name = 'qq'
 
     def fetch_lyric(self, name: str, artist: str = '', album: str = '', song_id: int = 0) -> Optional[str]:
-        result = self.api_search_song(name, artist, album)
-        item_list = result.get('data', {}).get('song', {}).get('itemlist', None)
-        if not item_list:
-            return None
-        mid = item_list[0].get('mid', None)
+        mid = self.search_track(name, artist, album).get('mid', None)
         if not mid:
             return None
         lyric_result = self.api_lyric(mid)
@@ -26,11 +22,22 @@ class QQMusicApi(BaseProvider):
         return base64.b64decode(lyric).decode('utf-8')
 
     def fetch_cover(self, name: str, artist: str = '', album: str = '', song_id: int = 0) -> Optional[str]:
-        result = self.api_search_song(name, artist, album)
-        item_list = result.get('data', {}).get('album', {}).get('itemlist', None)
-        if not item_list:
-            return None
-        return item_list[0].get('pic', None)
+        return self.search_track(name, artist, album).get('pic', None)
+
+    def search_track(self, name: str, artist: str = '', album: str = '') -> dict:
+        '''Return the song mid and album cover url of the best match, one search serves lyric and cover.'''
+        def search():
+            result = self.api_search_song(name, artist, album).get('data', {})
+            ids = {}
+            song_list = result.get('song', {}).get('itemlist', None)
+            if song_list and song_list[0].get('mid', None):
+                ids['mid'] = song_list[0]['mid']
+            album_list = result.get('album', {}).get('itemlist', None)
+            if album_list and album_list[0].get('pic', None):
+                ids['pic'] = album_list[0]['pic']
+            return ids or None
+
+        return self.memoized_search(name, artist, search) or {}
 
     def api_search_song(self, name: str, artist: str = '', album: str = ''):
         key = quote_plus(f'{name} {artist}'.strip())
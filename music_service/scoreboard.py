@@ -0,0 +1,153 @@
+import json
+import os.path
+import threading
+import time
+from typing import Dict, List
+
+from music_service.utils import get_logger
+
+log = get_logger('Scoreboard')
+
+HIT = 'hit'
+EMPTY = 'empty'
+ERROR = 'error'
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class _ProviderStats:
+    __slots__ = ('hits', 'empties', 'errors', 'latency', 'consecutive_errors', 'opened_at', 'trial')
+
+    def __init__(self, hits=0, empties=0, errors=0, latency=1.0, consecutive_errors=0, opened_at=0.0):
+        self.hits = hits
+        self.empties = empties
+        self.errors = errors
+        # Moving average of seconds per call, starts at a pessimistic guess.
+        self.latency = latency
+        self.consecutive_errors = consecutive_errors
+        # Wall clock time the circuit opened, 0 while it is closed.
+        self.opened_at = opened_at
+        # A half-open circuit lets one call through at a time.
+        self.trial = False
+
+    def to_dict(self) -> dict:
+        return {'hits': self.hits, 'empties': self.empties, 'errors': self.errors, 'latency': self.latency,
+                'consecutive_errors': self.consecutive_errors, 'opened_at': self.opened_at}
+
+    def score(self) -> float:
+        # Results per second, the hit rate is smoothed so few samples stay near the middle.
+        hit_rate = (self.hits + 1) / (self.hits + self.empties + self.errors + 2)
+        return hit_rate / max(self.latency, 0.05)
+
+
+class ProviderScoreboard:
+    '''
+    Success rate and latency of every provider, per kind of lookup.
+
+    `order` sorts providers by expected results per second, registration
+    order breaks ties, so new providers keep their place until they have a
+    record. After `FAILURE_THRESHOLD` errors in a row a provider's circuit
+    opens and `allow` refuses it; after `COOL_DOWN` seconds one call is let
+    through, its success closes the circuit, its failure opens it again.
+    Answering nothing is not a failure.
+
+    Stats are saved to `file_path` at most every `SAVE_INTERVAL` seconds
+    and on every circuit change. Methods may be called from any thread.
+    '''
+
+    FAILURE_THRESHOLD = 3
+    COOL_DOWN = 300
+    SAVE_INTERVAL = 30
+    # Weight of the newest sample in the latency average.
+    LATENCY_ALPHA = 0.2
+
+    def __init__(self, file_path: str):
+        self._file_path = file_path
+        self._stats: Dict[str, _ProviderStats] = {}
+        self._last_save = 0.0
+        self._lock = threading.Lock()
+
+        self._load()
+
+    def _load(self):
+        if os.path.isfile(self._file_path):
+            try:
+                with open(self._file_path, 'r') as fp:
+                    data = fp.read()
+                self._stats = {key: _ProviderStats(**value) for key, value in json.loads(data).items()}
+            except Exception as e:
+                log.error(f'load provider stats failed: {e}')
+
+    def _save(self):
+        self._last_save = time.monotonic()
+        with open(self._file_path, 'w') as fp:
+            fp.write(json.dumps({key: stats.to_dict() for key, stats in self._stats.items()}))
+
+    def _get(self, kind: str, provider_name: str) -> _ProviderStats:
+        key = f'{kind}:{provider_name}'
+        stats = self._stats.get(key, None)
+        if stats is None:
+            stats = self._stats[key] = _ProviderStats()
+        return stats
+
+    def order(self, kind: str, provider_names: List[str]) -> List[str]:
+        with self._lock:
+            scores = {name: self._get(kind, name).score() for name in provider_names}
+        return sorted(provider_names, key=lambda name: -scores[name])
+
+    def is_open(self, kind: str, provider_name: str) -> bool:
+        '''Whether `allow` would refuse a call now, without taking the half-open trial.'''
+        with self._lock:
+            stats = self._get(kind, provider_name)
+            return bool(stats.opened_at) and (stats.trial or time.time() - stats.opened_at < self.COOL_DOWN)
+
+    def allow(self, kind: str, provider_name: str) -> bool:
+        '''Call right before the call it allows: a half-open trial is only released by its `record`.'''
+        with self._lock:
+            stats = self._get(kind, provider_name)
+            if not stats.opened_at:
+                return True
+            if stats.trial or time.time() - stats.opened_at < self.COOL_DOWN:
+                return False
+            log.debug(f'half-open {kind} circuit of {provider_name}')
+            stats.trial = True
+            return True
+
+    def record(self, kind: str, provider_name: str, outcome: str, latency: float):
+        with self._lock:
+            stats = self._get(kind, provider_name)
+            stats.latency += self.LATENCY_ALPHA * (latency - stats.latency)
+            circuit_changed = False
+            if outcome == ERROR:
+                stats.errors += 1
+                stats.consecutive_errors += 1
+                if stats.trial or (not stats.opened_at and stats.consecutive_errors >= self.FAILURE_THRESHOLD):
+                    log.debug(f'open {kind} circuit of {provider_name} after {stats.consecutive_errors} errors')
+                    stats.opened_at = time.time()
+                    circuit_changed = True
+            else:
+                if outcome == HIT:
+                    stats.hits += 1
+                else:
+                    stats.empties += 1
+                stats.consecutive_errors = 0
+                if stats.opened_at:
+                    log.debug(f'close {kind} circuit of {provider_name}')
+                    stats.opened_at = 0.0
+                    circuit_changed = True
+            stats.trial = False
+            if circuit_changed or time.monotonic() - self._last_save >= self.SAVE_INTERVAL:
+                self._save()
+
+    def report(self) -> str:
+        with self._lock:
+            lines = []
+            for key in sorted(self._stats):
+                stats = self._stats[key]
+                total = stats.hits + stats.empties + stats.errors
+                state = 'open' if stats.opened_at else 'closed'
+                lines.append(f'{key:<20} {total:>6} calls  {stats.hits:>6} hits  {stats.empties:>6} empty  '
+                             f'{stats.errors:>6} errors  {stats.latency * 1000:>7.0f} ms  circuit {state}')
+            return '\n'.join(lines)
@@ -0,0 +1,99 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Tuple
+
+from music_service.task_pool import SingleFlight
+from music_service.utils import get_logger
+
+log = get_logger('SearchMemo')
+
+
+class SearchMemo:
+    '''
+    What each provider's search found for a track, persisted in SQLite.
+
+    Entries are keyed by provider name and the track's casefolded artist and
+    title, so a local file maps to the same provider ids (Netease song id,
+    QQ song mid, ...) wherever it is moved, and every track is searched once
+    per provider for good. Values are anything JSON can hold. A search that
+    found nothing is remembered for `negative_ttl` seconds only, 0 doesn't
+    remember it at all; a search that raised is never remembered.
+
+    Concurrent `resolve` calls for the same entry run one search. Methods may
+    be called from any thread.
+    '''
+
+    def __init__(self, db_file: str, negative_ttl: float = 0):
+        self._negative_ttl = negative_ttl
+        self._single_flight = SingleFlight()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS memo ('
+                           'provider TEXT NOT NULL, '
+                           'artist TEXT NOT NULL, '
+                           'title TEXT NOT NULL, '
+                           'value TEXT, '
+                           'added REAL NOT NULL, '
+                           'PRIMARY KEY (provider, artist, title))')
+        # Drop expired negatives, they are searched again.
+        self._conn.execute('DELETE FROM memo WHERE value IS NULL AND added < ?', (time.time() - negative_ttl,))
+        self._conn.commit()
+        # key -> (value, time added), lookups don't touch the database.
+        self._entries: Dict[Tuple[str, str, str], Tuple[Any, float]] = {
+            (provider, artist, title): (None if value is None else json.loads(value), added)
+            for provider, artist, title, value, added in self._conn.execute('SELECT * FROM memo')}
+
+    @staticmethod
+    def _key(provider_name: str, name: str, artist: str) -> Tuple[str, str, str]:
+        return provider_name, artist.strip().casefold(), name.strip().casefold()
+
+    def _get(self, key: Tuple[str, str, str]) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get(key, None)
+        if entry is None:
+            return False, None
+        value, added = entry
+        if value is None and time.time() - added >= self._negative_ttl:
+            return False, None
+        return True, value
+
+    def _put(self, key: Tuple[str, str, str], value: Any):
+        if value is None and self._negative_ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (value, now)
+            self._conn.execute('INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?, ?)',
+                               key + (None if value is None else json.dumps(value), now))
+            self._conn.commit()
+
+    def resolve(self, provider_name: str, name: str, artist: str, search: Callable[[], Any]) -> Any:
+        '''Return the memoized result of `search` for the track, running it if there is none.'''
+        key = self._key(provider_name, name, artist)
+        found, value = self._get(key)
+        if found:
+            return value
+        return self._single_flight.do(key, self._search, key, search)
+
+    def _search(self, key: Tuple[str, str, str], search: Callable[[], Any]) -> Any:
+        # The call we joined late may have just stored it.
+        found, value = self._get(key)
+        if found:
+            return value
+        log.debug(f'search {key}')
+        value = search()
+        self._put(key, value)
+        return value
+
+    def purge_negatives(self) -> int:
+        with self._lock:
+            keys = [key for key, (value, _) in self._entries.items() if value is None]
+            for key in keys:
+                del self._entries[key]
+            self._conn.execute('DELETE FROM memo WHERE value IS NULL')
+            self._conn.commit()
+            return len(keys)
@@ -1,14 +1,21 @@
 import html
+import os
 import os.path
 import re
 import json
 import base64
+import time
 from collections import OrderedDict
-from typing import Dict, Optional
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from PIL import Image
 
 from music_service.base import BaseProvider, BaseSongProvider
+from music_service.miss_cache import MissCache
+from music_service.scoreboard import EMPTY, ERROR, HIT, CircuitOpenError, ProviderScoreboard
+from music_service.search_memo import SearchMemo
+from music_service.task_pool import SingleFlight
 from music_service.utils import download_file, get_logger
 
 try:
@@ -34,6 +41,12 @@ def check_lyric_is_valid(lyric: str) -> bool:
 def refine_lyrics(lyrics: str) -> str:
     return re.sub(r'\[(ti|ar|al|by|offset):.*?\](\n|\r\n)', '', lyrics)
 
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
 def check_cover_is_valid(cover_path: str) -> bool:
     if not os.path.exists(cover_path):
         return False
@@ -61,6 +74,17 @@ class MusicService:
         self._prividers = OrderedDict()
         self._song_prividers = OrderedDict()
         self._bridge_server_port = 0
+        # Buffers and quick track switches ask for the same lyric or cover at once, look it up once.
+        self._single_flight = SingleFlight()
+        # Lyrics and covers no provider has, not looked up again until they expire.
+        self._miss_cache: Optional[MissCache] = None
+        # Query all providers at once and take the first good result, see `_first_result`.
+        self._race = False
+        self._race_grace = 0.3
+        # Reorders providers by their record and skips failing ones.
+        self._scoreboard: Optional[ProviderScoreboard] = None
+        # What providers' searches found per track, shared by lyric and cover lookups.
+        self._search_memo: Optional[SearchMemo] = None
 
     def run_bridge_server(self, port: int):
         if bridge_server:
@@ -80,7 +104,162 @@ class MusicService:
         url = base64.b64encode(url.encode('utf-8')).decode('utf-8')
         return f'http://127.0.0.1:{self._bridge_server_port}/forward?url={url}&headers={headers}'
 
+    def set_miss_cache(self, miss_cache: Optional[MissCache]):
+        self._miss_cache = miss_cache
+
+    def get_miss_cache(self) -> Optional[MissCache]:
+        return self._miss_cache
+
+    def purge_misses(self) -> int:
+        count = 0
+        if self._miss_cache is not None:
+            count += self._miss_cache.purge()
+        if self._search_memo is not None:
+            count += self._search_memo.purge_negatives()
+        return count
+
+    def set_search_memo(self, search_memo: Optional[SearchMemo]):
+        self._search_memo = search_memo
+        for provider in self._prividers.values():
+            provider.search_memo = search_memo
+
+    def get_search_memo(self) -> Optional[SearchMemo]:
+        return self._search_memo
+
+    def set_race_mode(self, race: bool, grace: float = 0.3):
+        self._race = race
+        self._race_grace = grace
+
+    def set_scoreboard(self, scoreboard: Optional[ProviderScoreboard]):
+        self._scoreboard = scoreboard
+
+    def get_scoreboard(self) -> Optional[ProviderScoreboard]:
+        return self._scoreboard
+
+    def get_provider_report(self) -> str:
+        if self._scoreboard is None:
+            return ''
+        return self._scoreboard.report()
+
+    def _scored_attempts(self, kind: str,
+                         attempts: List[Tuple[str, Callable[[], Any]]]) -> Tuple[List[Tuple[str, Callable[[], Any]]], bool]:
+        '''Return attempts ordered by the scoreboard and timed into it, and whether any was skipped.'''
+        scoreboard = self._scoreboard
+        if scoreboard is None:
+            return attempts, False
+
+        def timed(provider_name, attempt):
+            # Decided when the attempt runs, attempts never reached don't hold a half-open trial.
+            if not scoreboard.allow(kind, provider_name):
+                raise CircuitOpenError(f'{provider_name} {kind} circuit is open')
+            start = time.monotonic()
+            try:
+                result = attempt()
+            except Exception:
+                scoreboard.record(kind, provider_name, ERROR, time.monotonic() - start)
+                raise
+            scoreboard.record(kind, provider_name, HIT if result is not None else EMPTY, time.monotonic() - start)
+            return result
+
+        by_name = dict(attempts)
+        scored = []
+        skipped = False
+        for provider_name in scoreboard.order(kind, list(by_name)):
+            if scoreboard.is_open(kind, provider_name):
+                log.debug(f'provider: {provider_name} {kind} circuit is open, skip')
+                skipped = True
+                continue
+            attempt = by_name[provider_name]
+            scored.append((provider_name, lambda provider_name=provider_name, attempt=attempt: timed(provider_name, attempt)))
+        return scored, skipped
+
+    def _first_result(self, kind: str, attempts: List[Tuple[str, Callable[[], Any]]],
+                      discard: Optional[Callable[[Any], None]] = None) -> Tuple[Any, bool]:
+        '''
+        Run `attempts`, (provider name, function) pairs in preference order, and
+        return (first result that is not None, whether any attempt raised).
+
+        In race mode all attempts run at once. Once a result arrives, the more
+        preferred attempts still running get `_race_grace` seconds to come up
+        with theirs, so when several arrive close together the choice doesn't
+        depend on timing. Every race runs on its own threads, so attempts that
+        lost and still run never hold up another lookup; they are not waited
+        for, `discard` is called with every result that lost, whenever it
+        arrives.
+        '''
+        # A skipped provider may have had it, as if it failed.
+        attempts, failed = self._scored_attempts(kind, attempts)
+        if not self._race:
+            for provider_name, attempt in attempts:
+                try:
+                    result = attempt()
+                    if result is not None:
+                        return result, failed
+                except CircuitOpenError as e:
+                    log.debug(f'provider: {provider_name} skipped, {e}')
+                    failed = True
+                except Exception as e:
+                    log.exception(f'provider: {provider_name} fetch {kind} error: {e}')
+                    failed = True
+            return None, failed
+
+        if not attempts:
+            return None, failed
+        executor = ThreadPoolExecutor(max_workers=len(attempts), thread_name_prefix=f'ProviderRace-{kind}')
+        futures = [executor.submit(attempt) for _, attempt in attempts]
+        index_of = {future: index for index, future in enumerate(futures)}
+        pending = set(futures)
+        best = None
+        deadline = None
+        while pending:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            done, pending = wait(pending, timeout, FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                index = index_of[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    log.error(f'provider: {attempts[index][0]} fetch {kind} error: {e}')
+                    failed = True
+                    continue
+                if result is not None and (best is None or index < best):
+                    best = index
+            if best is not None:
+                if deadline is None:
+                    deadline = time.monotonic() + self._race_grace
+                if all(index_of[future] > best for future in pending):
+                    break
+        # Threads exit as soon as their attempt returns, nothing is left queued.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        def discard_loser(future):
+            if not future.cancelled() and future.exception() is None and future.result() is not None:
+                discard(future.result())
+
+        for index, future in enumerate(futures):
+            if index != best:
+                future.cancel()
+                if discard is not None:
+                    future.add_done_callback(discard_loser)
+        if best is None:
+            return None, failed
+        log.debug(f'provider: {attempts[best][0]} won the {kind} race')
+        return futures[best].result(), failed
+
+    def _is_miss(self, key: tuple) -> bool:
+        if self._miss_cache is not None and self._miss_cache.is_miss(key):
+            log.debug(f'skip lookup known to find nothing: {key}')
+            return True
+        return False
+
+    def _add_miss(self, key: tuple):
+        if self._miss_cache is not None:
+            self._miss_cache.add(key)
+
     def register_provider(self, provider: BaseProvider):
+        provider.search_memo = self._search_memo
         self._prividers[provider.provider_name] = provider
 
     def register_song_provider(self, provider: BaseSongProvider):
@@ -97,42 +276,82 @@ class MusicService:
         name = refine(name)
         artist = refine(artist)
         album = refine(album)
-        for provider in self._prividers.values():
-            try:
-                log.debug(f'fetch lyric provider: {provider.provider_name} name: {name}, ' \
-                          f'artist: {artist}, album: {album}')
-                result = provider.fetch_lyric(name, artist, album, song_id)
-                if result and check_lyric_is_valid(result):
-                    return html.unescape(refine_lyrics(result))
-            except Exception as e:
-                log.exception(f'provider: {provider.provider_name} fetch lyric error: {e}')
-                continue
-        return None
+        key = ('lyric', artist.casefold(), name.casefold())
+        if self._is_miss(key):
+            return None
+        return self._single_flight.do(key, self._fetch_lyric, key, name, artist, album, song_id)
+
+    def _fetch_lyric(self, key: tuple, name: str, artist: str, album: str, song_id: int) -> Optional[str]:
+        def fetch(provider):
+            log.debug(f'fetch lyric provider: {provider.provider_name} name: {name}, ' \
+                      f'artist: {artist}, album: {album}')
+            result = provider.fetch_lyric(name, artist, album, song_id)
+            if result and check_lyric_is_valid(result):
+                return html.unescape(refine_lyrics(result))
+            return None
+
+        attempts = [(provider.provider_name, lambda provider=provider: fetch(provider))
+                    for provider in self._prividers.values()]
+        lyric, failed = self._first_result('lyric', attempts)
+        # A provider that failed may have had it, only remember answers.
+        if lyric is None and not failed:
+            self._add_miss(key)
+        return lyric
 
 
     def fetch_cover(self, save_path: str, name: str, artist: str = '', album: str = '', song_id: int = 0) -> bool:
         name = refine(name)
         artist = refine(artist)
         album = refine(album)
-        for provider in self._prividers.values():
-            try:
-                cover_url = provider.fetch_cover(name, artist, album, song_id)
-                log.debug(f'fetch cover provider: {provider.provider_name} ' \
-                          f'name: {name}, cover_url: {cover_url}')
-                if cover_url and download_file(cover_url, save_path):
-                    if check_cover_is_valid(save_path):
-                        return True
-            except Exception as e:
-                log.exception(f'provider: {provider.provider_name} fetch cover error: {e}')
-                continue
+        miss_key = ('cover', artist.casefold(), name.casefold())
+        if self._is_miss(miss_key):
+            return False
+        # The save path is part of the key, callers sharing a download share the file it writes.
+        key = miss_key + (save_path,)
+        return self._single_flight.do(key, self._fetch_cover, miss_key, save_path, name, artist, album, song_id)
+
+    def _fetch_cover(self, miss_key: tuple, save_path: str, name: str, artist: str, album: str, song_id: int) -> bool:
+        def fetch(provider):
+            cover_url = provider.fetch_cover(name, artist, album, song_id)
+            log.debug(f'fetch cover provider: {provider.provider_name} ' \
+                      f'name: {name}, cover_url: {cover_url}')
+            if not cover_url:
+                return None
+            # Racing providers download side by side, the winner is moved to `save_path`.
+            temp_path = f'{save_path}.{provider.provider_name}.tmp'
+            if not download_file(cover_url, temp_path):
+                remove_file(temp_path)
+                raise IOError(f'download {cover_url} failed')
+            if check_cover_is_valid(temp_path):
+                return temp_path
+            return None
+
+        attempts = [(provider.provider_name, lambda provider=provider: fetch(provider))
+                    for provider in self._prividers.values()]
+        temp_path, failed = self._first_result('cover', attempts, discard=remove_file)
+        if temp_path is not None:
+            os.replace(temp_path, save_path)
+            return True
+        if not failed:
+            self._add_miss(miss_key)
         return False
 
     def fetch_song_url(self, name: str, artist: str = '', album: str = '') -> Optional[str]:
         name = refine(name)
         artist = refine(artist)
         album = refine(album)
-        for provider in self._song_prividers.values():
+
+        def fetch(provider):
             log.debug(f'fetch song url provider: {provider.provider_name} search name: {name}')
+            url = provider.fetch_song_url(name, artist, album)
+            if not url:
+                return None
+            if provider.require_bridge:
+                url = self._get_bridge_song_url(url, provider.get_bridge_http_headers())
+            return url
+
+        attempts = []
+        for provider in self._song_prividers.values():
             if provider.use_proprietary_codecs and not self.has_proprietary_codecs:
                 log.debug(f'fetch song url provider: {provider.provider_name} require proprietary_codecs, ingonre')
                 continue
@@ -141,15 +360,8 @@ class MusicService:
                 log.debug(f'fetch song url provider: {provider.provider_name} require bridge, ingonre')
                 continue
 
-            try:
-                url = provider.fetch_song_url(name, artist, album)
-                if not url:
-                    continue
-                if provider.require_bridge:
-                    url = self._get_bridge_song_url(url, provider.get_bridge_http_headers())
-                return url
-            except Exception as e:
-                log.exception(f'provider: {provider.provider_name} fetch song url error: {e}')
-                continue
+            attempts.append((provider.provider_name, lambda provider=provider: fetch(provider)))
+        url, _ = self._first_result('song url', attempts)
+        return url
 
 music_service = MusicService()
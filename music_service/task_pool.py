@@ -0,0 +1,232 @@
+import collections
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from music_service.utils import get_logger
+
+log = get_logger('TaskPool')
+
+
+class _Task:
+    __slots__ = ('group', 'func', 'args', 'callback')
+
+    def __init__(self, group: Hashable, func: Callable, args: tuple, callback: Optional[Callable]):
+        self.group = group
+        self.func = func
+        self.args = args
+        self.callback = callback
+
+
+class TaskPool:
+    '''
+    A fixed number of worker threads fed by a bounded queue.
+
+    Every task belongs to a group, for example the unikey of the track it
+    was submitted for. `set_current_group` drops the pending tasks of all
+    other groups, tasks already running finish but their callers are
+    expected to ignore stale results. When the queue is full, the oldest
+    pending task is dropped. Workers are started on first use and live as
+    long as the pool, so thread count and memory stay flat however many
+    tasks go through.
+
+    `callback(result)` is called in the worker thread, decorate it with
+    `PostGui` to touch the GUI.
+    '''
+
+    def __init__(self, name: str, workers: int = 4, max_pending: int = 32):
+        self._name = name
+        self._workers = workers
+        self._max_pending = max_pending
+        self._tasks = collections.deque()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._current_group = None
+        self._stopped = False
+
+    def submit(self, group: Hashable, func: Callable, *args: Any, callback: Optional[Callable] = None):
+        with self._condition:
+            if len(self._tasks) >= self._max_pending:
+                dropped = self._tasks.popleft()
+                log.debug(f'{self._name} queue is full, drop task {dropped.func.__name__}')
+            self._tasks.append(_Task(group, func, args, callback))
+            if len(self._threads) < self._workers:
+                thread = threading.Thread(target=self._work, name=f'{self._name}-{len(self._threads)}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify()
+
+    def set_current_group(self, group: Hashable):
+        with self._condition:
+            self._current_group = group
+            pending = len(self._tasks)
+            self._tasks = collections.deque(task for task in self._tasks if task.group == group)
+            if pending != len(self._tasks):
+                log.debug(f'{self._name} cancel {pending - len(self._tasks)} stale tasks')
+
+    def pending_count(self) -> int:
+        with self._condition:
+            return len(self._tasks)
+
+    def shutdown(self):
+        with self._condition:
+            self._stopped = True
+            self._tasks.clear()
+            self._condition.notify_all()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._tasks and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                task = self._tasks.popleft()
+
+            try:
+                result = task.func(*task.args)
+            except Exception as e:
+                log.exception(f'{self._name} task {task.func.__name__} failed: {e}')
+                continue
+
+            if task.callback:
+                try:
+                    task.callback(result)
+                except Exception as e:
+                    log.exception(f'{self._name} callback of {task.func.__name__} failed: {e}')
+
+
+class _LaneStats:
+    __slots__ = ('limit', 'running', 'done', 'total_wait', 'max_wait')
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.running = 0
+        self.done = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+
+class TaskScheduler:
+    '''
+    Run tasks of several priority lanes on a fixed set of worker threads.
+
+    `lanes` maps each lane name to the number of tasks it may run at once,
+    in priority order: a free worker always takes the oldest task of the
+    first lane that has one pending and is under its limit. Keeping the
+    lower lanes' limits below `workers` leaves threads for the first one.
+    Queue depth and the time tasks waited are reported by `stats`.
+    '''
+
+    # Tasks that waited longer are logged with the scheduler stats.
+    SLOW_WAIT = 1.0
+
+    def __init__(self, name: str, lanes: Dict[str, int], workers: int = 4):
+        self._name = name
+        self._workers = workers
+        self._lanes = {lane: collections.deque() for lane in lanes}
+        self._stats = {lane: _LaneStats(limit) for lane, limit in lanes.items()}
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def submit(self, lane: str, func: Callable, *args: Any, callback: Optional[Callable] = None):
+        with self._condition:
+            self._lanes[lane].append((time.monotonic(), func, args, callback))
+            if len(self._threads) < self._workers:
+                thread = threading.Thread(target=self._work, name=f'{self._name}-{len(self._threads)}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify()
+
+    def stats(self) -> Dict[str, dict]:
+        with self._condition:
+            return {lane: {'pending': len(self._lanes[lane]),
+                           'running': stats.running,
+                           'done': stats.done,
+                           'avg_wait': stats.total_wait / stats.done if stats.done else 0.0,
+                           'max_wait': stats.max_wait}
+                    for lane, stats in self._stats.items()}
+
+    def _next_task(self):
+        for lane, tasks in self._lanes.items():
+            stats = self._stats[lane]
+            if tasks and stats.running < stats.limit:
+                return lane, tasks.popleft()
+        return None, None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                lane, task = self._next_task()
+                while task is None:
+                    self._condition.wait()
+                    lane, task = self._next_task()
+                stats = self._stats[lane]
+                stats.running += 1
+                submit_time, func, args, callback = task
+                wait = time.monotonic() - submit_time
+                stats.total_wait += wait
+                stats.max_wait = max(stats.max_wait, wait)
+
+            if wait > self.SLOW_WAIT:
+                log.debug(f'{self._name} {lane} task {func.__name__} waited {wait:.2f}s, stats: {self.stats()}')
+
+            try:
+                result = func(*args)
+                if callback:
+                    callback(result)
+            except Exception as e:
+                log.exception(f'{self._name} {lane} task {func.__name__} failed: {e}')
+            finally:
+                with self._condition:
+                    stats.running -= 1
+                    stats.done += 1
+                    # A lane at its limit may have pending tasks another worker can take now.
+                    self._condition.notify_all()
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+    Coalesce concurrent calls for the same key into one.
+
+    The first caller of `do` runs the function, callers arriving with the
+    same key while it runs wait and get its result, or its exception.
+    Nothing is cached: once the call returns, the next one runs again.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    def do(self, key: Hashable, func: Callable, *args: Any) -> Any:
+        with self._lock:
+            flight = self._flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            log.debug(f'join in-flight call {func.__name__} for {key}')
+            flight.done.wait()
+        else:
+            try:
+                flight.result = func(*args)
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
@@ -0,0 +1,228 @@
+from operator import attrgetter
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+from music_service.collation import collation_key
+
+TrackKey = Union[str, int]
+
+# Collation keys compared for each sort field, the later ones break ties.
+SORT_FIELDS = {
+    'name': attrgetter('name_key', 'artist_key', 'album_key'),
+    'artist': attrgetter('artist_key', 'album_key', 'name_key'),
+    'album': attrgetter('album_key', 'artist_key', 'name_key')
+}
+
+
+class TrackRecord:
+    __slots__ = ('key', 'name', 'artist', 'album', 'status', 'name_key', 'artist_key', 'album_key')
+
+    def __init__(self, key: TrackKey, name: str, artist: str, album: str, status: bool):
+        self.key = key
+        self.name = name
+        self.artist = artist
+        self.album = album
+        self.status = status
+        self.name_key: Optional[str] = None
+        self.artist_key: Optional[str] = None
+        self.album_key: Optional[str] = None
+
+
+class TrackTable:
+    '''
+    Compact store of track infos shared by the local and the cloud playlist.
+
+    Tracks are `__slots__` records addressed by integer track ids, with an
+    index from the track key (local path or cloud song id) to the id. Artist
+    and album strings are interned per table, so the thousands of tracks of
+    one album share one string. Ids stay stable while their key is in the
+    table, removed ids are never reused.
+
+    The webview only knows tracks by id, see `encode`. Collation keys are
+    computed when a track is added, the id order for each sort field is
+    built on first request and kept until the table changes, see `order`.
+
+    Lookups return a fresh dict in the shape the webview expects, callers
+    may change it without touching the table.
+    '''
+
+    def __init__(self, key_field: str):
+        self._key_field = key_field
+        self._records: List[Optional[TrackRecord]] = []
+        self._ids: Dict[TrackKey, int] = {}
+        self._strings: Dict[str, str] = {}
+        self._collation_keys: Dict[str, str] = {}
+        self._orders: Dict[str, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, key: TrackKey) -> bool:
+        return key in self._ids
+
+    def _intern(self, value: str) -> str:
+        return self._strings.setdefault(value, value)
+
+    def _collate(self, value: str) -> str:
+        # Artists and albums repeat, share their keys like their strings.
+        key = self._collation_keys.get(value, None)
+        if key is None:
+            key = self._collation_keys[value] = collation_key(value)
+        return key
+
+    def _set_collation_keys(self, record: TrackRecord):
+        record.name_key = collation_key(record.name)
+        record.artist_key = self._collate(record.artist)
+        record.album_key = self._collate(record.album)
+
+    def _to_dict(self, record: TrackRecord) -> dict:
+        info = {
+            self._key_field: record.key,
+            'name': record.name,
+            'artist': record.artist,
+            'album': record.album
+        }
+        if self._key_field == 'id':
+            info['status'] = record.status
+        return info
+
+    def clear(self):
+        self._records = []
+        self._ids = {}
+        self._strings = {}
+        self._collation_keys = {}
+        self._orders = {}
+
+    def add(self, info: dict) -> int:
+        '''Add or update the track of `info`, return its track id.'''
+        key = info[self._key_field]
+        track_id = self._ids.get(key, None)
+        record = TrackRecord(key,
+                             info['name'],
+                             self._intern(info['artist']),
+                             self._intern(info['album']),
+                             info.get('status', True))
+        self._set_collation_keys(record)
+        self._orders = {}
+        if track_id is None:
+            track_id = len(self._records)
+            self._records.append(record)
+            self._ids[key] = track_id
+        else:
+            self._records[track_id] = record
+        return track_id
+
+    def extend(self, infos: Iterable[dict]):
+        for info in infos:
+            self.add(info)
+
+    def replace(self, infos: Iterable[dict]):
+        '''
+        Replace all tracks by `infos`, tracks that stay keep their ids.
+
+        Records of unchanged tracks are kept as they are, usually all of them
+        after a scan streamed them in, so no collation key is computed twice.
+        '''
+        # Interned strings and collation keys of removed tracks are kept, they are few.
+        old_ids = self._ids
+        self._ids = {}
+        self._orders = {}
+        records = self._records
+        for info in infos:
+            key = info[self._key_field]
+            track_id = old_ids.pop(key, None)
+            if track_id is None:
+                self.add(info)
+                continue
+            self._ids[key] = track_id
+            record = records[track_id]
+            if (record.name != info['name'] or record.artist != info['artist'] or
+                    record.album != info['album'] or record.status != info.get('status', True)):
+                self.add(info)
+        for track_id in old_ids.values():
+            self._records[track_id] = None
+
+    def update(self, key: TrackKey, name: str, artist: str, album: str):
+        track_id = self._ids.get(key, None)
+        if track_id is None:
+            return
+        record = self._records[track_id]
+        record.name = name
+        record.artist = self._intern(artist)
+        record.album = self._intern(album)
+        self._set_collation_keys(record)
+        self._orders = {}
+
+    def remove(self, key: TrackKey):
+        track_id = self._ids.pop(key, None)
+        if track_id is not None:
+            self._records[track_id] = None
+            self._orders = {}
+
+    def get_id(self, key: TrackKey) -> Optional[int]:
+        return self._ids.get(key, None)
+
+    def get_key(self, track_id: int) -> Optional[TrackKey]:
+        if 0 <= track_id < len(self._records) and self._records[track_id] is not None:
+            return self._records[track_id].key
+        return None
+
+    def encode(self, keys: Iterable[TrackKey], last_key: Optional[TrackKey] = None) -> dict:
+        '''
+        Return the tracks of `keys` as a columnar payload for the webview.
+
+        Tracks are sent as ids, names and indexes into deduplicated artist and
+        album lists, the keys themselves (long local paths) stay in Python.
+        `lastTrackId` is the id of `last_key`, or -1.
+        '''
+        artists = {}
+        albums = {}
+        payload = {
+            'ids': [],
+            'names': [],
+            'artists': [],
+            'albums': [],
+            'artistNames': [],
+            'albumNames': []
+        }
+        for key in keys:
+            track_id = self._ids.get(key, None)
+            if track_id is None:
+                continue
+            record = self._records[track_id]
+            payload['ids'].append(track_id)
+            payload['names'].append(record.name)
+            if record.artist not in artists:
+                artists[record.artist] = len(artists)
+                payload['artistNames'].append(record.artist)
+            payload['artists'].append(artists[record.artist])
+            if record.album not in albums:
+                albums[record.album] = len(albums)
+                payload['albumNames'].append(record.album)
+            payload['albums'].append(albums[record.album])
+
+        last_id = self._ids.get(last_key, None) if last_key else None
+        payload['lastTrackId'] = -1 if last_id is None else last_id
+        return payload
+
+    def order(self, field: str) -> List[int]:
+        '''Return the ids of all tracks sorted by `field`, one of `SORT_FIELDS`.'''
+        if field not in SORT_FIELDS:
+            raise ValueError(f'unknown sort field: {field}')
+
+        ids = self._orders.get(field, None)
+        if ids is None:
+            sort_key = SORT_FIELDS[field]
+            ids = sorted(self._ids.values(), key=lambda track_id: sort_key(self._records[track_id]))
+            self._orders[field] = ids
+        return ids
+
+    def get(self, key: TrackKey) -> Optional[dict]:
+        track_id = self._ids.get(key, None)
+        if track_id is None:
+            return None
+        return self._to_dict(self._records[track_id])
+
+    def __iter__(self) -> Iterator[dict]:
+        for record in self._records:
+            if record is not None:
+                yield self._to_dict(record)
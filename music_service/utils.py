@@ -1,6 +1,7 @@
 import logging
 import os.path
 import platform
+from typing import Optional
 
 import requests
 
@@ -52,6 +53,14 @@ def download_file(url, filename) -> bool:
             logger.exception(f'[eaf-music-player] download file error: {e}')
     return False
 
+def get_content_length(url) -> Optional[int]:
+    try:
+        response = requests.head(url.strip(), allow_redirects=True, timeout=5)
+        return int(response.headers.get('Content-Length', 0)) or None
+    except Exception as e:
+        logger.error(f'[eaf-music-player] get content length error: {e}')
+        return None
+
 def get_cloud_cache_dir():
     cache_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'src', 'cloud_cache')
     if not os.path.isdir(cache_dir):
@@ -71,6 +80,17 @@ def get_cookie_cache_file(name: str) -> str:
 def get_temp_cache_file(name: str) -> str:
     return get_cloud_cache_file('temp', name)
 
+def clean_temp_cache_files():
+    # Downloads interrupted by a crash or an exit, nothing else is left in there.
+    temp_dir = os.path.join(get_cloud_cache_dir(), 'temp')
+    if not os.path.isdir(temp_dir):
+        return
+    for name in os.listdir(temp_dir):
+        try:
+            os.remove(os.path.join(temp_dir, name))
+        except OSError as e:
+            logger.error(f'[eaf-music-player] remove temp file {name} error: {e}')
+
 def get_db_cache_file(name: str) -> str:
     return get_cloud_cache_file('db', name)
 
@@ -1,48 +1,49 @@
 import json
 import os.path
-import queue
 import shutil
+import threading
 import time
 from typing import Any
 
 from core.utils import PostGui, get_emacs_var
 from core.webengine import BrowserBuffer
-from PyQt6.QtCore import QThread, pyqtSignal
+from PyQt6.QtCore import QTimer
 
 from music_service import music_service, utils
+from music_service.file_cache import get_shared_cache
 from music_service.netease import NeteaseMusicApi
+from music_service.task_pool import SingleFlight, TaskScheduler
+from music_service.track_table import TrackTable
 from music_service.utils import normalize_path
 
 logger = utils.get_logger('NeteaseBackend')
 
 
-class SafeThread(QThread):
-    _notify_signal = pyqtSignal(object)
+# Lanes of the task scheduler in priority order, with the number of tasks each may run at once.
+# UI refresh, prefetch and caching never take all workers, one is always left for playback.
+PLAYBACK_LANE = 'playback'
+UI_LANE = 'ui'
+PREFETCH_LANE = 'prefetch'
+BACKGROUND_LANE = 'background'
+SCHEDULER_LANES = {PLAYBACK_LANE: 4, UI_LANE: 2, PREFETCH_LANE: 1, BACKGROUND_LANE: 1}
+# One more than the other lanes' limits together.
+SCHEDULER_WORKERS = 5
 
-    def __init__(self, exec_func, handle_func=None, handle_arg=None, *args, **kwargs):
-        super().__init__()
-        self._notify_signal.connect(self._do_notify)
-        self._exec_func = exec_func
-        self._handle_func = handle_func
-        self._handle_arg = handle_arg
-        self._exec_args = args
-        self._exec_kwargs = kwargs
+# Pause between two mp3 cache downloads, and between two login qrcode checks.
+CACHE_MP3_INTERVAL = 2.0
+QRCODE_CHECK_INTERVAL = 1000
 
-    def run(self):
-        try:
-            result = self._exec_func(*self._exec_args, **self._exec_kwargs)
-        except Exception as e:
-            logger.exception(f'SafeThread exec func: {self._exec_func.__name__}, failed: {e}')
-            result = None
-        self._notify_signal.emit(result)
+# Song urls are signed and expire after about 20 minutes, reuse resolved ones for less than that.
+SONG_URL_TTL = 600
 
-    def _do_notify(self, result: Any):
-        if not self._handle_func:
-            return
-        try:
-            self._handle_func(result, self._handle_arg)
-        except Exception as e:
-            logger.exception(f'SafeThread handle func: {self._handle_func.__name__}, failed: {e}')
+# Every play of a cached mp3 counts as this many seconds of recency when evicting.
+PLAY_WEIGHT = 24 * 3600
+
+# Assumed size of a stream whose length the server doesn't tell, about 5 minutes of 320k mp3.
+STREAM_SIZE_ESTIMATE = 12 * 1024 * 1024
+
+# Leftovers of crashed downloads are removed once per process, by the first backend.
+_temp_files_cleaned = False
 
 
 class NeteaseBackend:
@@ -50,37 +51,65 @@ class NeteaseBackend:
     def __init__(self, buffer: BrowserBuffer):
         self._buffer = buffer
         self._api: NeteaseMusicApi = music_service.get_provider('netease')
-        self._thread_caches = []
+        self._scheduler = TaskScheduler('NeteaseScheduler', SCHEDULER_LANES, workers=SCHEDULER_WORKERS)
+        self._single_flight = SingleFlight()
+        # song id -> (url, expire time), filled by playback and prefetch.
+        self._song_urls = {}
+        self._song_urls_lock = threading.Lock()
 
         # current tracks
-        self._track_infos = {}
+        self._track_infos = TrackTable('id')
+        self._last_track_id = 0
 
         # playlists
         self._like_playlist_id = 0
         self._current_playlist_id = 0
         self._user_playlists = []
 
-        self._cache_queue = queue.Queue()
         self._logined = False
 
         self.music_cache_dir = get_emacs_var("eaf-music-cache-dir")
         if self.music_cache_dir == "":
             self.music_cache_dir = os.path.join(utils.get_cloud_cache_dir(), "music")
             logger.debug(f'music cache dir: {self.music_cache_dir}')
+        cache_size = get_emacs_var("eaf-music-cache-size")
+        self._audio_files = get_shared_cache('audio_files', normalize_path(self.music_cache_dir),
+                                             cache_size if isinstance(cache_size, int) and cache_size > 0 else 0,
+                                             extension='.mp3', play_weight=PLAY_WEIGHT)
+        # Later backends would delete the downloads of the running ones.
+        global _temp_files_cleaned
+        if not _temp_files_cleaned:
+            _temp_files_cleaned = True
+            self._thread_post(BACKGROUND_LANE, utils.clean_temp_cache_files)
+
+    def get_audio_cache_stats(self):
+        return self._audio_files.stats()
+
+    def _thread_post(self, lane: str, exec_func, handle_func=None, handle_arg=None, *args):
+        def execute():
+            try:
+                return exec_func(*args)
+            except Exception as e:
+                logger.exception(f'exec func: {exec_func.__name__}, failed: {e}')
+                return None
 
-    def get_music_cache_file(self, name):
-        if not os.path.exists(self.music_cache_dir):
-            os.makedirs(self.music_cache_dir)
+        self._scheduler.submit(lane, execute,
+                               callback=lambda result: self._post_handle(handle_func, result, handle_arg))
 
-        return normalize_path(os.path.join(self.music_cache_dir, name))
+    @PostGui()
+    def _post_handle(self, handle_func, result: Any, handle_arg: Any):
+        if not handle_func:
+            return
+        try:
+            handle_func(result, handle_arg)
+        except Exception as e:
+            logger.exception(f'handle func: {handle_func.__name__}, failed: {e}')
 
-    def _thread_post(self, exec_func, handle_func=None, handle_arg=None, *args, **kwargs):
-        task = SafeThread(exec_func, handle_func, handle_arg, *args, **kwargs)
-        self._thread_caches.append(task)
-        task.start()
+    def _js_post(self, lane: str, exec_func, js_method: str, handle_func=None, handle_arg=None, *args):
+        self._thread_post(lane, exec_func, self._eval_js_handle(js_method, handle_func), handle_arg, *args)
 
-    def _js_post(self, exec_func, js_method: str, handle_func=None, handle_arg=None, *args, **kwargs):
-        self._thread_post(exec_func, self._eval_js_handle(js_method, handle_func), handle_arg, *args, **kwargs)
+    def get_scheduler_stats(self):
+        return self._scheduler.stats()
 
     def _eval_js_handle(self, js_method: str, handle_func=None):
         def wrapper(result: Any, handle_arg: Any):
@@ -96,7 +125,8 @@ class NeteaseBackend:
     def _post_exec_js(self, js_method, val):
         self._exec_js(js_method, val)
 
-    def init_app(self, default_playlist_id: int):
+    def init_app(self, default_playlist_id: int, default_track_id: int = 0):
+        self._last_track_id = default_track_id
         if self._load_playlists():
             if default_playlist_id == self._like_playlist_id or default_playlist_id == 0:
                 load_state = self._load_like_songs()
@@ -108,8 +138,8 @@ class NeteaseBackend:
         else:
             self._load_like_songs()
 
-        self._thread_post(self._api.is_login, self._handle_user_login)
-        self._thread_post(self._start_cache_mp3_task)
+        self._thread_post(BACKGROUND_LANE, self._read_cache, self._pin_like_songs, None, 'tracks.json')
+        self._thread_post(UI_LANE, self._api.is_login, self._handle_user_login)
 
     def _handle_user_login(self, is_login, _):
         logger.debug(f'login state: {is_login}')
@@ -139,16 +169,25 @@ class NeteaseBackend:
         return self._load_playlist_songs('tracks.json')
 
     def _load_playlist_songs(self, filename: str) -> bool:
+        songs = self._read_cache(filename)
+        if songs is not None:
+            self._update_track_infos(songs)
+            logger.debug(f'load songs from cache: {filename}')
+            return True
+        return False
+
+    def _read_cache(self, filename: str) -> Any:
         db_file = utils.get_db_cache_file(filename)
         if os.path.isfile(db_file):
             with open(db_file, 'r') as fp:
                 data = fp.read()
-            songs = json.loads(data)
-            self._track_infos = { x['id']: x for x in songs }
-            self._exec_js('cloudUpdateTrackInfos', songs)
-            logger.debug(f'load songs from cache: {os.path.basename(db_file)}')
-            return True
-        return False
+            return json.loads(data)
+        return None
+
+    def _pin_like_songs(self, songs, _=None):
+        # Liked songs stay cached whatever the quota, only other tracks are evicted.
+        if songs:
+            self._audio_files.set_pinned(get_mp3_name(song) for song in songs)
 
     def _save_cache(self, filename: str, data: Any):
         json_data = json.dumps(data)
@@ -168,7 +207,7 @@ class NeteaseBackend:
         if not self._logined:
             logger.debug('refresh playlists require login')
             return
-        self._js_post(self._api.get_user_playlist, 'cloudUpdatePlaylists', self._handle_playlists)
+        self._js_post(UI_LANE, self._api.get_user_playlist, 'cloudUpdatePlaylists', self._handle_playlists)
 
     def _handle_playlists(self, playlists, _):
         if not playlists:
@@ -188,7 +227,8 @@ class NeteaseBackend:
 
     def refresh_playlist_songs(self, playlist_id: int):
         logger.debug(f'start refresh playlist songs, playlist: {playlist_id}')
-        self._thread_post(self._api.get_playlist_songs,
+        self._thread_post(UI_LANE,
+                          self._api.get_playlist_songs,
                           self._handle_playlist_songs,
                           playlist_id,
                           playlist_id)
@@ -201,17 +241,37 @@ class NeteaseBackend:
         logger.debug(f'refresh playlist: {playlist_id} success, cache it')
         if playlist_id == self._like_playlist_id:
             self._save_like_songs(songs)
+            self._pin_like_songs(songs)
         else:
             self._save_playlist_songs(playlist_id, songs)
 
         if self._current_playlist_id == playlist_id:
             logger.debug(f'update current playlist track infos, playlist: {playlist_id}')
-            self._track_infos = {x['id']: x for x in songs }
-            self._exec_js('cloudUpdateTrackInfos', songs)
+            self._update_track_infos(songs)
+
+    def _update_track_infos(self, songs):
+        self._track_infos.replace(songs)
+        self._exec_js('cloudUpdateTrackInfos',
+                      self._track_infos.encode([x['id'] for x in songs], self._last_track_id))
+
+    def get_track_key(self, track_id: int):
+        song_id = self._track_infos.get_key(track_id)
+        if song_id:
+            self._last_track_id = song_id
+        return song_id
+
+    def get_prefetch_track_info(self, track_id: int):
+        song_id = self._track_infos.get_key(track_id)
+        if song_id is None:
+            return None
+        return self._track_infos.get(song_id)
+
+    def get_track_order(self, field: str):
+        return self._track_infos.order(field)
 
     def get_track_info(self, song_id):
         song_id = int(song_id)
-        return self._track_infos.get(song_id, None)
+        return self._track_infos.get(song_id)
 
     def get_playlist_songs(self, playlist_id):
         playlist_id = int(playlist_id)
@@ -221,7 +281,7 @@ class NeteaseBackend:
             logger.debug(f'load playlist: {playlist_id} cache failed, start fetch from net')
             self.refresh_playlist_songs(playlist_id)
 
-    def fetch_track_audio_source(self, song_id, track_unikey):
+    def fetch_track_audio_source(self, song_id, track_unikey, preloaded=False):
         logger.debug(f'fetch track audio source, song_id: {song_id}')
         song_id = int(song_id)
 
@@ -229,24 +289,54 @@ class NeteaseBackend:
         if not info:
             return
 
-        mp3_name = f"{info['artist']}_{info['name']}.mp3"
-        cache_mp3_file = self.get_music_cache_file(mp3_name)
+        mp3_name = get_mp3_name(info)
+        cache_mp3_file = self._audio_files.lookup(mp3_name)
         song_status = info.get('status', True)
-        if os.path.exists(cache_mp3_file):
-            self._exec_js('cloudUpdateTrackAudioSource', cache_mp3_file)
+        if cache_mp3_file:
+            self._audio_files.record_play(mp3_name)
+            if not preloaded:
+                self._exec_js('updateTrackAudioSource', cache_mp3_file)
         else:
             self._cache_quality_mp3(song_id, mp3_name, song_status)
-            if song_status:
-                self._thread_post(self.get_song_url, self._handle_fetch_audio_source, track_unikey, song_id)
-            else:
-                self._thread_post(self.get_song_url_by_other_source,
-                                  self._handle_fetch_audio_source, track_unikey, song_id)
+            # The panel already plays the source it preloaded.
+            if preloaded:
+                return
+            self._thread_post(PLAYBACK_LANE, self.get_song_url, self._handle_fetch_audio_source, track_unikey,
+                              song_id, song_status)
+
+    def resolve_audio_source(self, info):
+        # Blocking, called from prefetch workers: the source playback would use, and its size in bytes.
+        cache_mp3_file = self._audio_files.lookup(get_mp3_name(info))
+        if cache_mp3_file:
+            return cache_mp3_file, os.path.getsize(cache_mp3_file)
+        url = self.get_song_url(info['id'], info.get('status', True))
+        if not url:
+            return None
+        return url, utils.get_content_length(url) or STREAM_SIZE_ESTIMATE
+
+    def prefetch_track_audio_source(self, info):
+        if get_mp3_name(info) in self._audio_files:
+            return
+        self._thread_post(PREFETCH_LANE, self.get_song_url, None, None, info['id'], info.get('status', True))
 
-    def get_song_url(self, song_id: int):
-        url = self._api.get_song_url(song_id)
+    def get_song_url(self, song_id: int, status: bool = True):
+        with self._song_urls_lock:
+            cached = self._song_urls.get(song_id, None)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        return self._single_flight.do(('song_url', song_id), self._get_song_url, song_id, status)
+
+    def _get_song_url(self, song_id: int, status: bool):
+        url = self._api.get_song_url(song_id) if status else None
+        if not url:
+            url = self.get_song_url_by_other_source(song_id)
         if url:
-            return url
-        return self.get_song_url_by_other_source(song_id)
+            now = time.monotonic()
+            with self._song_urls_lock:
+                for expired_id in [key for key, (_, expire_time) in self._song_urls.items() if expire_time <= now]:
+                    del self._song_urls[expired_id]
+                self._song_urls[song_id] = (url, now + SONG_URL_TTL)
+        return url
 
     def get_song_url_by_other_source(self, song_id: int):
         info = self.get_track_info(song_id)
@@ -260,16 +350,16 @@ class NeteaseBackend:
         if not url:
             url = ''
         if self._buffer.is_current_play_track(track_unikey):
-            logger.debug(f'cloudUpdateTrackAudioSource url: {url}')
-            self._exec_js('cloudUpdateTrackAudioSource', url)
+            logger.debug(f'updateTrackAudioSource url: {url}')
+            self._exec_js('updateTrackAudioSource', url)
         else:
             logger.debug('is not current track, ignore')
 
     def _login_qr_create(self):
-        self._js_post(self._api.login_qr_create, 'cloudUpdateLoginQr')
+        self._js_post(UI_LANE, self._api.login_qr_create, 'cloudUpdateLoginQr')
 
         logger.info('start login qrcode check task')
-        self._thread_post(self._loop_check_qrcode)
+        self._check_login_qr()
 
     @PostGui()
     def _do_login_success(self):
@@ -280,44 +370,53 @@ class NeteaseBackend:
         logger.info('start refresh playlists')
         self.refresh_playlists()
 
-    def _loop_check_qrcode(self):
-        while True:
-            try:
-                result = self._api.login_qr_check()
-                code = result.get('code')
-
-                # expired
-                if code == 800:
-                    qrcode = self._api.login_qr_create()
-                    logger.debug(f'loign qrcode is expired, renew: {qrcode}')
-                    self._post_exec_js('cloudUpdateLoginQr', qrcode)
-                elif code == 803:
-                    logger.debug('login qrcode success')
-                    self._do_login_success()
-                    break
-            except Exception as e:
-                logger.exception(f'login qr check error, {e}')
-            time.sleep(1.0)
+    def _check_login_qr(self):
+        self._thread_post(UI_LANE, self._fetch_login_qr_state, self._handle_login_qr_state)
+
+    def _fetch_login_qr_state(self):
+        result = self._api.login_qr_check()
+        code = result.get('code')
+
+        # expired
+        if code == 800:
+            qrcode = self._api.login_qr_create()
+            logger.debug(f'loign qrcode is expired, renew: {qrcode}')
+            self._post_exec_js('cloudUpdateLoginQr', qrcode)
+        return code
+
+    def _handle_login_qr_state(self, code, _):
+        if code == 803:
+            logger.debug('login qrcode success')
+            self._do_login_success()
+        else:
+            # Check again later instead of holding a worker in a loop.
+            QTimer.singleShot(QRCODE_CHECK_INTERVAL, self._check_login_qr)
 
     def _cache_quality_mp3(self, song_id: int, mp3_name: str, status: bool):
         if self._current_playlist_id == self._like_playlist_id:
-            self._cache_queue.put((song_id, mp3_name, status))
-
-    def _start_cache_mp3_task(self):
-        while True:
-            task = self._cache_queue.get()
-            if task:
-                try:
-                    song_id, mp3_name, status = task
-                    if status:
-                        url = self._api.get_exhigh_song_url(song_id)
-                    else:
-                        url = self.get_song_url_by_other_source(song_id)
-                    if url:
-                        temp_file = utils.get_temp_cache_file(mp3_name)
-                        if utils.download_file(url, temp_file):
-                            mp3_file = self.get_music_cache_file(mp3_name)
-                            shutil.move(temp_file, mp3_file)
-                except Exception as e:
-                    logger.exception(f'cache mp3 task, failed: {e}')
-            time.sleep(2)
+            self._thread_post(BACKGROUND_LANE, self._cache_mp3, None, None, song_id, mp3_name, status)
+
+    def _cache_mp3(self, song_id: int, mp3_name: str, status: bool):
+        # The background lane runs one task at a time, downloads stay sequential and spaced out.
+        # Queued more than once when played again before the download finished.
+        if mp3_name in self._audio_files:
+            return
+        try:
+            if status:
+                url = self._api.get_exhigh_song_url(song_id)
+            else:
+                url = self.get_song_url_by_other_source(song_id)
+            if url:
+                temp_file = utils.get_temp_cache_file(mp3_name)
+                if utils.download_file(url, temp_file):
+                    shutil.move(temp_file, self._audio_files.get_path(mp3_name))
+                    self._audio_files.add(mp3_name)
+                elif os.path.exists(temp_file):
+                    os.remove(temp_file)
+        except Exception as e:
+            logger.exception(f'cache mp3 task, failed: {e}')
+        time.sleep(CACHE_MP3_INTERVAL)
+
+
+def get_mp3_name(info) -> str:
+    return "{}_{}.mp3".format(info['artist'].replace("/", "_"), info['name'].replace("/", "_"))
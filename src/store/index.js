@@ -3,6 +3,12 @@ import Vuex from "vuex"
 
 Vue.use(Vuex)
 
+// Position of every id in the lists of the same name, so the mutations find a
+// track without scanning. Kept outside the state, Vue doesn't need to observe them.
+const localTrackPositions = new Map();
+const cloudTrackPositions = new Map();
+const cloudPlaylistPositions = new Map();
+
 const store = new Vuex.Store({
     state: {
         // settings
@@ -12,6 +18,7 @@ const store = new Vuex.Store({
         localCurrentTrackIndex: -1,
         localNumberWidth: 0,
         localTrackInfos: [],
+        localScanning: true,
 
         // lyric
         currentLyric: "",
@@ -39,13 +46,9 @@ const store = new Vuex.Store({
         displaySource: 'local',
     },
     getters: {
-        localCurrentTrackPath: state => {
-            var track = state.localTrackInfos[state.localCurrentTrackIndex];
-            return track.path;
-        },
         currentPlayTrackKey: state => {
             if (isLocalSourceType(state.playSource)) {
-                return state.localTrackInfos[state.localCurrentTrackIndex].path;
+                return state.localTrackInfos[state.localCurrentTrackIndex].id;
             } else {
                 return state.cloudTrackInfos[state.cloudCurrentTrackIndex].id;
             }
@@ -72,59 +75,108 @@ const store = new Vuex.Store({
             state.localCurrentTrackIndex = index;
         },
 
-        updateLocalTrackInfos(state, infos) {
-            state.localTrackInfos = infos;
+        updateLocalTrackInfos(state, payload) {
+            // keep current track, or load last play track
+            var currentTrackId = payload.lastTrackId;
+            if (state.localCurrentTrackIndex !== -1) {
+                currentTrackId = state.localTrackInfos[state.localCurrentTrackIndex].id;
+            }
+
+            state.localTrackInfos = decodeTrackInfos(payload);
+            state.localNumberWidth = state.localTrackInfos.length.toString().length;
+            state.localScanning = false;
+            indexTrackInfos(localTrackPositions, state.localTrackInfos, 0);
+            state.localCurrentTrackIndex = trackPosition(localTrackPositions, currentTrackId);
+        },
+
+        appendLocalTrackInfos(state, payload) {
+            var infos = decodeTrackInfos(payload);
+            indexTrackInfos(localTrackPositions, infos, state.localTrackInfos.length);
+            state.localTrackInfos.push(...infos);
+            state.localNumberWidth = state.localTrackInfos.length.toString().length;
+
+            // load last play track as soon as it is scanned
+            if (state.localCurrentTrackIndex === -1 && payload.lastTrackId !== -1) {
+                state.localCurrentTrackIndex = trackPosition(localTrackPositions, payload.lastTrackId);
+            }
+        },
+
+        patchLocalTrackInfos(state, payload) {
+            var currentTrack = state.localTrackInfos[state.localCurrentTrackIndex];
+
+            // update changed tracks in place and append new ones
+            decodeTrackInfos(payload.tracks).forEach(function (track) {
+                var index = trackPosition(localTrackPositions, track.id);
+                if (index !== -1) {
+                    state.localTrackInfos.splice(index, 1, track);
+                } else {
+                    localTrackPositions.set(track.id, state.localTrackInfos.length);
+                    state.localTrackInfos.push(track);
+                }
+            });
+
+            // dropping tracks shifts the ones after them, reindex once
+            if (payload.removed.length > 0) {
+                var removed = new Set(payload.removed);
+                state.localTrackInfos = state.localTrackInfos.filter(function (track) { return !removed.has(track.id) });
+                indexTrackInfos(localTrackPositions, state.localTrackInfos, 0);
+            }
             state.localNumberWidth = state.localTrackInfos.length.toString().length;
 
-            // load last play track
-            if (state.settings.local_track_path) {
-                var tracks = state.localTrackInfos.map(function (track) { return track.path });
-                state.localCurrentTrackIndex = tracks.indexOf(state.settings.local_track_path);
+            // keep current track
+            if (currentTrack !== undefined) {
+                state.localCurrentTrackIndex = trackPosition(localTrackPositions, currentTrack.id);
             }
         },
 
         updateLocalTrackTagInfo(state, payload) {
-            var tracks = state.localTrackInfos.map(function (track) { return track.path });
-            var index = tracks.indexOf(payload.track);
+            var index = trackPosition(localTrackPositions, payload.id);
+            if (index === -1) {
+                return;
+            }
 
-            state.localTrackInfos[index].name = payload.name;
-            state.localTrackInfos[index].artist = payload.artist;
-            state.localTrackInfos[index].album = payload.album;
+            // track infos are frozen, swap in a new one
+            state.localTrackInfos.splice(index, 1, Object.freeze({
+                id: payload.id,
+                name: payload.name,
+                artist: payload.artist,
+                album: payload.album
+            }));
         },
 
         // sort
-        sortTrackInfos(state, compareType) {
-            var isLocal = isLocalSourceType(state.displaySource)
+        sortTrackInfos(state, payload) {
+            // payload.ids is the sorted id order computed in python, only reorder
+            var isLocal = isLocalSourceType(payload.source)
             var trackInfos = null;
             var currentTrack = null;
+            var positions = null;
             if (isLocal) {
                 currentTrack = state.localTrackInfos[state.localCurrentTrackIndex];
                 trackInfos = state.localTrackInfos;
+                positions = localTrackPositions;
             } else {
                 currentTrack = state.cloudTrackInfos[state.cloudCurrentTrackIndex];
                 trackInfos = state.cloudTrackInfos;
+                positions = cloudTrackPositions;
             }
-            trackInfos.sort(function (a, b) {
-                var compareA, compareB;
-                if (compareType === "title") {
-                    compareA = a.name;
-                    compareB = b.name;
-                } else if (compareType === "artist") {
-                    compareA = a.artist;
-                    compareB = b.artist;
-                } else if (compareType === "album") {
-                    compareA = a.album;
-                    compareB = b.album;
+
+            var sortedInfos = [];
+            payload.ids.forEach(function (id) {
+                var index = positions.get(id);
+                if (index !== undefined) {
+                    sortedInfos.push(trackInfos[index]);
                 }
-                return charCompare(compareA, compareB);
             });
 
+            indexTrackInfos(positions, sortedInfos, 0);
+            var currentIndex = currentTrack === undefined ? -1 : trackPosition(positions, currentTrack.id);
             if (isLocal) {
-                state.localTrackInfos = trackInfos;
-                state.localCurrentTrackIndex = trackInfos.indexOf(currentTrack);
+                state.localTrackInfos = sortedInfos;
+                state.localCurrentTrackIndex = currentIndex;
             } else {
-                state.cloudTrackInfos = trackInfos;
-                state.cloudCurrentTrackIndex = trackInfos.indexOf(currentTrack);
+                state.cloudTrackInfos = sortedInfos;
+                state.cloudCurrentTrackIndex = currentIndex;
             }
         },
 
@@ -153,22 +205,22 @@ const store = new Vuex.Store({
             state.cloudCurrentTrackIndex = index;
         },
 
-        updateCloudTrackInfos(state, infos) {
-            var currentTrackId = 0;
+        updateCloudTrackInfos(state, payload) {
+            var currentTrackId = -1;
             if (state.cloudTrackInfos.length > 0) {
                 if (state.cloudCurrentTrackIndex !== -1) {
                     currentTrackId = state.cloudTrackInfos[state.cloudCurrentTrackIndex].id;
                 }
             } else {
                 // load config
-                currentTrackId = state.settings.cloud_track_id;
+                currentTrackId = payload.lastTrackId;
             }
-            state.cloudTrackInfos = infos;
+            state.cloudTrackInfos = decodeTrackInfos(payload);
             state.cloudNumberWidth = state.cloudTrackInfos.length.toString().length;
+            indexTrackInfos(cloudTrackPositions, state.cloudTrackInfos, 0);
 
-            if (currentTrackId > 0) {
-                var trackIds = state.cloudTrackInfos.map(function (track) { return track.id });
-                var currentIndex = trackIds.indexOf(currentTrackId)
+            if (currentTrackId !== -1) {
+                var currentIndex = trackPosition(cloudTrackPositions, currentTrackId);
                 if (currentIndex !== -1) {
                     state.cloudCurrentTrackIndex = currentIndex;
                 }
@@ -185,9 +237,9 @@ const store = new Vuex.Store({
             }
 
             state.cloudPlaylists = infos;
+            indexTrackInfos(cloudPlaylistPositions, state.cloudPlaylists, 0);
             if (currentPlaylistId > 0) {
-                var playlistIds = state.cloudPlaylists.map(function (playlist) { return playlist.id });
-                var currentIndex = playlistIds.indexOf(currentPlaylistId)
+                var currentIndex = trackPosition(cloudPlaylistPositions, currentPlaylistId);
                 if (currentIndex !== -1) {
                     state.cloudCurrentPlaylistIndex = currentIndex;
                 }
@@ -216,29 +268,34 @@ const store = new Vuex.Store({
     }
 })
 
-function charCompare(charA, charB) {
-    if (charA === undefined || charA === null || charA === '' || charA === ' ' || charA === '　') {
-        return -1;
+// Expand the columnar payload of TrackTable.encode into frozen track infos,
+// frozen objects are not made reactive by Vue.
+function decodeTrackInfos(payload) {
+    var infos = new Array(payload.ids.length);
+    for (var i = 0; i < payload.ids.length; i++) {
+        infos[i] = Object.freeze({
+            id: payload.ids[i],
+            name: payload.names[i],
+            artist: payload.artistNames[payload.artists[i]],
+            album: payload.albumNames[payload.albums[i]]
+        });
     }
-    if (charB === undefined || charB === null || charB === '' || charB === ' ' || charB === '　') {
-        return 1;
+    return infos;
+}
+
+// Record the positions of `infos` starting at `offset`, 0 replaces the whole index.
+function indexTrackInfos(positions, infos, offset) {
+    if (offset === 0) {
+        positions.clear();
     }
-    if ((notChinese(charA) && notChinese(charB))) {
-        return charA.localeCompare(charB);
-    } else if (!notChinese(charA) && !notChinese(charB)){
-        return charA .localeCompare(charB, 'zh-Hans-CN', {sensitivity: 'accent'});
-    } else {
-        if (notChinese(charA)) {
-            return -1;
-        } else {
-            return 1;
-        }
+    for (var i = 0; i < infos.length; i++) {
+        positions.set(infos[i].id, offset + i);
     }
 }
 
-function notChinese(char) {
-    const charCode = char.charCodeAt(0);
-    return 0 <= charCode && charCode <= 128;
+function trackPosition(positions, id) {
+    var index = positions.get(id);
+    return index === undefined ? -1 : index;
 }
 
 function isLocalSourceType(source) {
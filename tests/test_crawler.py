@@ -0,0 +1,27 @@
+import threading
+
+import pytest
+
+from music_service.crawler import AudioCrawler
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_interrupted_crawl_stops_without_audio_files(tmp_path, workers):
+    for i in range(50):
+        (tmp_path / f'{i}' / 'empty').mkdir(parents=True)
+    crawler = AudioCrawler(['.mp3'], workers=workers)
+    listed = []
+    original = crawler._scan_directory
+    interrupt = threading.Event()
+
+    def scan_directory(directory, links):
+        listed.append(directory)
+        if len(listed) == 5:
+            interrupt.set()
+        return original(directory, links)
+
+    crawler._scan_directory = scan_directory
+    directories = []
+    assert list(crawler.crawl([str(tmp_path)], directories, interrupted=interrupt.is_set)) == []
+    assert len(directories) < 5
+    assert len(listed) < 101
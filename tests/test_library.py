@@ -0,0 +1,36 @@
+import os
+
+from music_service import library
+from music_service.crawler import AudioCrawler
+from music_service.library import MusicLibrary
+
+
+def scan(music_library, root):
+    files = AudioCrawler(['.mp3'], workers=1).crawl([root])
+    return [info for batch in music_library.scan_batches(root, files) for info in batch]
+
+
+def test_rescan_and_removal_below_non_bmp_directory(tmp_path, monkeypatch):
+    reads = []
+
+    def read_audio_tags(path):
+        reads.append(path)
+        return {'path': path, 'name': os.path.basename(path), 'artist': '', 'album': ''}
+
+    monkeypatch.setattr(library, 'read_audio_tags', read_audio_tags)
+    root = str(tmp_path / 'lib')
+    path = os.path.join(root, '\U0001F600', 'song.mp3')
+    os.makedirs(os.path.dirname(path))
+    open(path, 'wb').close()
+    music_library = MusicLibrary(str(tmp_path / 'library.db'))
+
+    assert [info['path'] for info in scan(music_library, root)] == [path]
+    assert reads == [path]
+
+    # Indexed and unchanged, not read again.
+    assert [info['path'] for info in scan(music_library, root)] == [path]
+    assert reads == [path]
+
+    os.remove(path)
+    assert scan(music_library, root) == []
+    assert music_library.forget(root) == []